@@ -1,15 +1,26 @@
 import pkg_resources
+import time
+from datetime import datetime
+from multiprocessing.dummy import Pool
+
 from trac.core import *
-from trac.web.chrome import ITemplateProvider, add_script, add_notice
-from trac.admin.api import IAdminPanelProvider
-from trac.config import Option
+from trac.web.chrome import ITemplateProvider, add_script, add_notice, \
+                            add_warning
+from trac.admin.api import IAdminPanelProvider, IAdminCommandProvider, \
+                           AdminCommandError
+from trac.config import Option, ListOption, ConfigSection
 from trac.ticket import Milestone
+from trac.util.text import printout
+
+from .burndown import BurnDownCharts
+
+from .workdays import parse_dates, team_calendars
 
 # Author: Danny Milsom <danny.milsom@cgi.com>
 
 class BurndownAdmin(Component):
 
-    implements(ITemplateProvider, IAdminPanelProvider)
+    implements(ITemplateProvider, IAdminPanelProvider, IAdminCommandProvider)
 
     unit_option = Option('burndown', 'units', 'tickets',
                     doc="The units of effort for the burndown chart")
@@ -23,6 +34,17 @@ class BurndownAdmin(Component):
                     to the milestone on its start date. If variable work added
                     after the milestone has started will be included.""")
 
+    holidays_option = ListOption('burndown', 'holidays', '',
+                    doc="""Dates (yyyy-mm-dd) which are not working days 
+                    for any milestone.""")
+
+    calendars_section = ConfigSection('burndown-calendars',
+                    """Team holiday calendars. Each `<name>` option lists 
+                    the holidays (yyyy-mm-dd) of a team, and the matching 
+                    `<name>.milestones` option lists the milestones which 
+                    use that team's calendar as well as the project 
+                    holidays.""")
+
     # IAdminPanelProvider
 
     def get_admin_panels(self, req):
@@ -43,23 +65,34 @@ class BurndownAdmin(Component):
             day_options = [('all', 'All'), ('weekdays', 'Weekdays')]
             valid_days = [i[0] for i in day_options]
 
-            # we can't calculate this without work added information, so
-            # we have to comment this out for now
-            # ideal_options = [('fixed', 'Fixed'), ('variable', 'Variable')]
-            # valid_ideal = [i[0] for i in ideal_options]
+            ideal_options = [('fixed', 'Fixed'), ('variable', 'Variable')]
+            valid_ideal = [i[0] for i in ideal_options]
+
+            if req.method == 'POST' and req.args.get('add_calendar'):
+                self._add_team_calendar(req)
+                req.redirect(req.href.admin(category, page))
+
+            if req.method == 'POST' and req.args.get('remove_calendar'):
+                self._remove_team_calendar(req, req.args.get('remove_calendar'))
+                req.redirect(req.href.admin(category, page))
 
             if req.method == 'POST':
 
                 unit_val = req.args.get('units')
                 days_val = req.args.get('days')
-                # ideal_val = req.args.get('ideal')
-
+                ideal_val = req.args.get('ideal')
 
                 # we only want to set a new value if its different to the current one
                 # and a value we recognise from the appropriate options list
-                #if ideal_val in valid_ideal and self.ideal_option != ideal_val:
-                    #self.env.config.set('burndown', 'ideal', ideal_val)
-                    #self.env.config.save()
+                if ideal_val in valid_ideal and self.ideal_option != ideal_val:
+                        self.env.config.set('burndown', 'ideal', ideal_val)
+                        self.env.config.save()
+                        if ideal_val == 'fixed':
+                            add_notice(req, 'Burndown chart ideal curves will '
+                            'now only include the effort on the start date')
+                        elif ideal_val == 'variable':
+                            add_notice(req, 'Burndown chart ideal curves will '
+                            'now include work added after the start date')
                 if unit_val in valid_units and self.unit_option != unit_val:
                         self.env.config.set('burndown', 'units', unit_val)
                         self.env.config.save()
@@ -75,20 +108,111 @@ class BurndownAdmin(Component):
                             add_notice(req, 'Burndown charts will now only '
                             'include weekdays (excluding Saturday and Sunday)')
 
+                holidays_val = req.args.get('holidays')
+                if holidays_val is not None:
+                    holidays, invalid = parse_dates(holidays_val)
+                    if invalid:
+                        add_warning(req, 'The following holidays are not '
+                        'yyyy-mm-dd dates and were ignored: %s'
+                        % ', '.join(invalid))
+                    if holidays != parse_dates(self.holidays_option)[0]:
+                        self.env.config.set('burndown', 'holidays',
+                                            ', '.join(holidays))
+                        self.env.config.save()
+                        add_notice(req, 'Burndown charts will now treat %d '
+                        'project holidays as non working days' % len(holidays))
+
             # Pass values to the template
             data = {'day_options': day_options,
                     'unit_options': unit_options,
-                    #'ideal_options': ideal_options,
+                    'ideal_options': ideal_options,
                     'current_day_value' : self.day_option,
                     'current_unit_value' : self.unit_option,
                     'current_ideal_value' : self.ideal_option,
+                    'holidays': parse_dates(self.holidays_option)[0],
+                    'team_calendars': team_calendars(self.calendars_section),
+                    'all_milestones': [m.name for m in
+                                       Milestone.select(self.env, True)],
                     'applicable_milestones' : self.milestones_with_start_and_end(),
                     }
 
+            charts = BurnDownCharts(self.env)
+            if charts.timing:
+                data['timing_stats'] = charts.timing_stats.percentiles()
+
             add_script(req, 'burndown/js/burndown_admin.js')
 
             return 'burndown_admin.html', data
 
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('burndown warm', '[--since yyyy-mm-dd] [--workers N]',
+               """Calculate and cache the burndown charts of open milestones
+
+               Run this after the history capture so that nobody has to
+               wait for the charts to be calculated. With --since, only
+               milestones with history captured on or after that date are
+               calculated, including milestones completed since then.
+               --workers sets the number of charts calculated at once
+               (default 4).""",
+               None, self._do_warm)
+
+    def _do_warm(self, *args):
+        since = None
+        workers = 4
+        args = list(args)
+        while args:
+            arg = args.pop(0)
+            try:
+                if arg == '--since':
+                    since = datetime.strptime(args.pop(0), '%Y-%m-%d').date()
+                elif arg == '--workers':
+                    workers = int(args.pop(0))
+                    if workers < 1:
+                        raise ValueError
+                else:
+                    raise AdminCommandError('Unknown argument %s' % arg,
+                                            show_usage=True)
+            except (IndexError, ValueError):
+                raise AdminCommandError('Invalid value for %s' % arg,
+                                        show_usage=True)
+
+        milestones = self.milestones_to_warm(since)
+        charts = BurnDownCharts(self.env)
+        total = len(milestones)
+        started = time.time()
+
+        def warm(milestone):
+            milestone_started = time.time()
+            try:
+                context = charts.context_for_milestone(None, milestone)
+                if context is None:
+                    result = 'no ticket data'
+                else:
+                    # each worker thread gets its own pooled connection
+                    db = self.env.get_read_db()
+                    charts.burndown_series(db, context, charts.metrics)
+                    result = 'done'
+            except Exception as e:
+                self.log.exception('Unable to warm the burndown chart for %s',
+                                   milestone.name)
+                result = 'failed: %s' % e
+            return milestone, result, time.time() - milestone_started
+
+        pool = Pool(workers)
+        try:
+            for i, (milestone, result, elapsed) in \
+                    enumerate(pool.imap_unordered(warm, milestones)):
+                printout('[%d/%d] %s: %s (%.2fs)'
+                         % (i + 1, total, milestone.name, result, elapsed))
+        finally:
+            pool.close()
+            pool.join()
+
+        printout('Warmed %d burndown charts in %.2fs with %d workers'
+                 % (total, time.time() - started, workers))
+
     # ITemplateProvider methods
 
     def get_htdocs_dirs(self):
@@ -98,6 +222,62 @@ class BurndownAdmin(Component):
     def get_templates_dirs(self):
         return [pkg_resources.resource_filename(__name__, 'templates')]
 
+    def _add_team_calendar(self, req):
+        """Adds or replaces a team calendar in the [burndown-calendars] 
+        section, using the calendar_name, calendar_holidays and 
+        calendar_milestones request arguments."""
+
+        name = req.args.get('calendar_name', '').strip()
+        if not name or name.endswith('.milestones') or \
+                any(c in name for c in '=[]:'):
+            add_warning(req, 'Please enter a valid team calendar name')
+            return
+
+        holidays, invalid = parse_dates(req.args.get('calendar_holidays', ''))
+        if invalid:
+            add_warning(req, 'The following holidays are not yyyy-mm-dd '
+            'dates and were ignored: %s' % ', '.join(invalid))
+
+        milestones = req.args.getlist('calendar_milestones')
+        self.env.config.set('burndown-calendars', name, ', '.join(holidays))
+        self.env.config.set('burndown-calendars', name + '.milestones',
+                            ', '.join(milestones))
+        self.env.config.save()
+        add_notice(req, 'The %s team calendar has been saved' % name)
+
+    def _remove_team_calendar(self, req, name):
+        """Removes a team calendar from the [burndown-calendars] section."""
+
+        self.env.config.remove('burndown-calendars', name)
+        self.env.config.remove('burndown-calendars', name + '.milestones')
+        self.env.config.save()
+        add_notice(req, 'The %s team calendar has been removed' % name)
+
+    def milestones_to_warm(self, since=None):
+        """Returns the open milestones. If a since date is given, only 
+        milestones with history captured on or after that date for them 
+        or any milestone below them are returned, including any completed 
+        on or after that date."""
+
+        db = self.env.get_read_db()
+        milestones = [milestone for milestone
+                      in Milestone.select(self.env, 'completed', db)
+                      if not milestone.completed or
+                      (since and milestone.completed.date() >= since)]
+        if since is None:
+            return milestones
+
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT DISTINCT milestone
+            FROM ticket_bi_historical
+            WHERE _snapshottime >= %s
+            """, [since])
+        changed = set(row[0] for row in cursor)
+        subtrees = BurnDownCharts(self.env).milestone_subtrees
+        return [milestone for milestone in milestones
+                if changed.intersection(subtrees.names(milestone.name))]
+
     def milestones_with_start_and_end(self):
         db = self.env.get_db_cnx()
 
@@ -0,0 +1,158 @@
+"""A single script holding everything the milestone page chart needs.
+
+The chart needs jqPlot, several jqPlot plugins, the jqPlot stylesheet and
+burndown.js. Rather than adding each of them to every milestone page, they
+are joined into one script. The URL of the script contains a hash of its
+content, so browsers can keep it forever and a new version of any file
+gets a new URL. A small loader, added along with the chart container,
+only fetches the script once the chart scrolls into view.
+
+The bundle is built the first time it is needed by each process, so
+changes to the files are picked up when Trac is restarted.
+"""
+
+import os
+import re
+from datetime import datetime, timedelta
+from hashlib import md5
+
+from trac.core import Component, implements
+from trac.util import lazy
+from trac.util.datefmt import utc, http_date
+from trac.util.presentation import to_json
+from trac.web.api import IRequestHandler, RequestDone
+from trac.web.chrome import Chrome
+
+# The scripts joined into the bundle, in the order they are loaded. Each
+# path is found in the htdocs directories of Trac and the plugins, in the
+# same way as paths passed to add_script(). Where a minified copy of a
+# file is shipped next to it, that is used instead. The scripts are joined
+# as they are; rewriting vendor code risks breaking it.
+SCRIPTS = (
+    'common/js/jqPlot/jquery.jqplot.js',
+    # excanvas is needed for IE8 support
+    'common/js/jqPlot/excanvas.min.js',
+    'common/js/jqPlot/plugins/jqplot.dateAxisRenderer.js',
+    'common/js/jqPlot/plugins/jqplot.highlighter.js',
+    'common/js/jqPlot/plugins/jqplot.canvasTextRenderer.js',
+    'common/js/jqPlot/plugins/jqplot.canvasAxisTickRenderer.js',
+    'common/js/jqPlot/plugins/jqplot.canvasAxisLabelRenderer.js',
+    'common/js/jqPlot/plugins/jqplot.enhancedLegendRenderer.js',
+    'burndown/js/burndown.js',
+)
+
+# The stylesheets added to the page by the bundle
+STYLESHEETS = (
+    'common/js/jqPlot/jquery.jqplot.css',
+)
+
+LOADER = 'burndown/js/burndown_loader.js'
+
+# Adds the stylesheets, passed as a JSON string, to the page
+STYLE_SCRIPT = """(function(css) {
+var style = document.createElement('style');
+style.setAttribute('type', 'text/css');
+if (style.styleSheet) { style.styleSheet.cssText = css; }
+else { style.appendChild(document.createTextNode(css)); }
+document.getElementsByTagName('head')[0].appendChild(style);
+})(%s)"""
+
+# Browsers may keep the bundle for a year, as its URL changes with it
+MAX_AGE = 365 * 24 * 60 * 60
+
+
+class BurndownBundle(Component):
+    """Serves the bundled chart script from /burndownchart-bundle/<hash>.js
+    with far-future caching headers."""
+
+    implements(IRequestHandler)
+
+    @lazy
+    def bundle(self):
+        """A tuple of the hash and content of the bundled script."""
+
+        parts = []
+        stylesheets = [self._read(path) for path in STYLESHEETS]
+        stylesheets = [css for css in stylesheets if css is not None]
+        if stylesheets:
+            parts.append(STYLE_SCRIPT % to_json('\n'.join(stylesheets)))
+        for path in SCRIPTS:
+            script = self._read(path)
+            if script is not None:
+                parts.append(script)
+
+        # a semicolon between the scripts, in case one doesn't end with one,
+        # on its own line in case one ends with a line comment
+        content = '\n;\n'.join(parts).encode('utf-8')
+        return md5(content).hexdigest()[:16], content
+
+    @lazy
+    def loader(self):
+        """The script which fetches the bundle, to add to the page along
+        with the chart container."""
+
+        return self._read(LOADER) or ''
+
+    def url(self, req):
+        """Returns the URL of the current version of the bundle."""
+
+        return req.href('burndownchart-bundle', self.bundle[0] + '.js')
+
+    def _read(self, path):
+        """Returns the unchanged content of a file in the htdocs
+        directories, or None if it can't be found."""
+
+        filename = self._htdocs_file(path)
+        if filename is None:
+            self.log.warning('Unable to add %s to the burndown chart '
+                             'script', path)
+            return None
+
+        with open(filename, 'rb') as f:
+            return f.read().decode('utf-8')
+
+    def _htdocs_file(self, path):
+        """Returns the file name of the path in the htdocs directories,
+        preferring a minified copy of a script if there is one."""
+
+        prefix, filename = path.split('/', 1)
+        candidates = [filename]
+        if filename.endswith('.js') and not filename.endswith('.min.js'):
+            candidates.insert(0, filename[:-3] + '.min.js')
+
+        for provider in Chrome(self.env).template_providers:
+            for dir_prefix, dirname in provider.get_htdocs_dirs() or []:
+                if dir_prefix != prefix or not dirname:
+                    continue
+                for candidate in candidates:
+                    candidate = os.path.join(dirname, *candidate.split('/'))
+                    if os.path.isfile(candidate):
+                        return candidate
+
+    # IRequestHandler methods
+
+    def match_request(self, req):
+        match = re.match(r'/burndownchart-bundle/([0-9a-f]+)\.js$',
+                         req.path_info)
+        if match:
+            req.args['hash'] = match.group(1)
+            return True
+
+    def process_request(self, req):
+        """Sends the bundle. Requests for an older version, from a page
+        rendered before Trac was restarted, are sent to the current one."""
+
+        hash, content = self.bundle
+        if req.args['hash'] != hash:
+            req.redirect(self.url(req))
+
+        expires = datetime.now(utc) + timedelta(seconds=MAX_AGE)
+        req.send_response(200)
+        req.send_header('Content-Type', 'text/javascript;charset=utf-8')
+        req.send_header('Content-Length', len(content))
+        req.send_header('Cache-Control', 'public, max-age=%d' % MAX_AGE)
+        req.send_header('Expires', http_date(expires))
+        req.end_headers()
+        if req.method != 'HEAD':
+            req.write(content)
+        raise RequestDone
@@ -1,25 +1,48 @@
+import os
 import pkg_resources
 import re
+from cStringIO import StringIO
+from gzip import GzipFile
+from hashlib import md5
+from email.utils import mktime_tz, parsedate_tz
 from datetime import datetime, date, timedelta, time
+from math import ceil
 
 from trac.core import *
-from trac.web.chrome import ITemplateProvider, add_script, add_script_data, \
-                            add_stylesheet, add_notice, add_ctxtnav
+from trac.web.chrome import ITemplateProvider, add_script_data, \
+                            add_notice, add_ctxtnav
 from trac.web import ITemplateStreamFilter
 from trac.ticket.model import Milestone
-from trac.web.api import IRequestFilter, IRequestHandler
-from trac.util.datefmt import to_utimestamp, utc,to_timestamp
-from trac.config import Option
+from trac.web.api import HTTPBadRequest, IRequestFilter, IRequestHandler, \
+                         RequestDone
+from trac.util.datefmt import utc, http_date
+from trac.config import BoolOption, IntOption, Option, ListOption, \
+                        ConfigSection
 from itertools import groupby
 from operator import itemgetter
 from genshi.filters.transform import Transformer
 from genshi.builder import tag
+from genshi.core import Markup
 from trac.env import IEnvironmentSetupParticipant
 from componentdependencies import IRequireComponents
 from businessintelligenceplugin.history import HistoryStorageSystem
 from logicaordertracker.controller import LogicaOrderController
 from trac.util.presentation import to_json
 from trac.resource import ResourceNotFound
+from trac.ticket.api import IMilestoneChangeListener
+from trac.cache import cached
+from trac.util import as_int, lazy
+
+from . import db_default
+from . import series
+from .context import BurndownContext
+from .workdays import get_calendar, parse_dates, team_calendars
+from . import render
+from .bundle import BurndownBundle
+from .upgrades.indexes import create_missing_indexes, missing_indexes
+from .timing import NULL_TIMER, PhaseStats, PhaseTimer
+from .cache import SeriesCache, StartDateCache, MilestoneSubtrees, \
+                   ClosedStatuses, RenderCache, DerivedCache
 
 # Author: Danny Milsom <danny.milsom@cgi.com>
 
@@ -34,9 +57,101 @@ class BurnDownCharts(Component):
 
     ideal_value = Option('burndown', 'ideal', 'fixed')
 
+    holidays = ListOption('burndown', 'holidays', '',
+                    doc="""Dates (yyyy-mm-dd) which are not working days 
+                    for any milestone.""")
+
+    timing = BoolOption('burndown', 'timing', 'false',
+                    doc="""Time each phase of drawing a burndown chart, and 
+                    send the durations as a Server-Timing header and to 
+                    the log. Percentiles are shown on the admin panel.""")
+
+    forecast_days = IntOption('burndown', 'forecast_days', 14,
+                    doc="""The number of days of remaining effort, counting 
+                    back from the last snapshot, used to project when a 
+                    milestone will be completed.""")
+
+    forecast_bands = BoolOption('burndown', 'forecast_bands', 'false',
+                    doc="""Show the range of completion dates the velocity 
+                    of completed milestones would give, as well as the 
+                    projected completion date. Only milestones whose 
+                    charts have been drawn are included.""")
+
+    calendars_section = ConfigSection('burndown-calendars',
+                    """Team holiday calendars. Each `<name>` option lists 
+                    the holidays (yyyy-mm-dd) of a team, and the matching 
+                    `<name>.milestones` option lists the milestones which 
+                    use that team's calendar as well as the project 
+                    holidays.""")
+
+    # The units of effort a burndown chart can be drawn with
+    metrics = ('tickets', 'hours', 'points')
+
+    # The keys of the series in the chart data for each metric
+    series_keys = ('burndowndata', 'teameffortdata', 'workaddeddata',
+                   'idealcurvedata')
+
+    # A velocity below this is rounding error rather than progress, and
+    # no forecast is made further ahead than this many days
+    min_forecast_velocity = 1e-9
+    max_forecast_days = 10 * 365
+
+    # The number of tickets whose snapshots are read by each query in
+    # ticket_snapshots(), which keeps within SQLite's parameter limit
+    snapshot_tickets_per_query = 500
+
+    # (trac.ini mtime, ClosedStatuses) - see closed_statuses_for_all_types()
+    _closed_statuses = None
+
     implements(ITemplateProvider, IRequestFilter,
                ITemplateStreamFilter, IRequireComponents,
-               IEnvironmentSetupParticipant, IRequestHandler)
+               IEnvironmentSetupParticipant, IRequestHandler,
+               IMilestoneChangeListener)
+
+    @lazy
+    def render_cache(self):
+        """The RenderCache holding images drawn for format=svg and 
+        format=png requests, kept in the files/burndown directory of the 
+        environment."""
+
+        return RenderCache(self.env, os.path.join(self.env.path, 'files',
+                                                  'burndown'))
+
+    @lazy
+    def downsample_cache(self):
+        """The DerivedCache holding series downsampled for requests with
+        a max_points argument."""
+
+        return DerivedCache()
+
+    @lazy
+    def forecast_cache(self):
+        """The DerivedCache holding the forecasts for each milestone and 
+        metric, and the velocities of completed milestones."""
+
+        return DerivedCache()
+
+    @lazy
+    def flow_cache(self):
+        """The DerivedCache holding the cumulative flow chart data for 
+        each milestone and metric."""
+
+        return DerivedCache()
+
+    @lazy
+    def timing_stats(self):
+        """The PhaseStats of requests handled by this process, when timing 
+        is enabled."""
+
+        return PhaseStats()
+
+    @cached
+    def milestone_subtrees(self):
+        """The milestone hierarchy, shared between requests so we don't 
+        load every milestone each time a chart is drawn. It is rebuilt 
+        after any milestone is created, changed or deleted."""
+
+        return MilestoneSubtrees(Milestone.build_tree(self.env))
 
     # IRequestFilter methods
 
@@ -48,40 +163,33 @@ class BurnDownCharts(Component):
         using a AJAX call which is picked up by the match_request() and 
         process_request() methods.
 
-        This method determines if we should send that AJAX call, by 
-        checking the milestone has both a start and end date. If so, the 
-        jqPlot JS files are loaded and the script data 'render_burndown'  
-        passed via JSON."""
+        Milestone pages are viewed very often, so nothing here touches the
+        database. Whether the milestone has a start date we can use (and 
+        so whether there is a chart at all) is decided by the AJAX call. 
+        This method only passes the script data 'render_burndown' and the 
+        URL of the chart script bundle via JSON, and marks the request so 
+        filter_stream() adds the chart container and the loader which 
+        fetches the bundle, see BurndownBundle."""
 
         # check we are on an individual milestone page
         if req.path_info.startswith("/milestone/") and req.args.get('id') \
             and "stats" in data:
 
-            milestone = self._get_milestone(req)
-            if milestone:
-                # Load the burn down JS file
-                add_script(req, 'burndown/js/burndown.js')
+            # the milestone page has already loaded the milestone for us
+            context = self.get_context(req, data.get('milestone'))
+            if context:
+                milestone = context.milestone
+                req._burndown_chart = True
 
-                if milestone.start:
-                    approx_start_date = False
-                else:
-                    # no milestone start value so try and estimate start date
-                    approx_start_date = self.guess_start_date(milestone)
-                    if not approx_start_date:
-                        # no milestone start or estimated start date
-                        # dont show a burn down chart
-                        add_script_data(req, {'render_burndown': False})
-                        return template, data, content_type
-
-                # If we do have a start date (explicit or implied), 
-                # tell JS it should send a request via JSON and use 
+                # Tell JS it should send a request via JSON and use 
                 # the default effort value
                 add_script_data(req, {
                                         'render_burndown': True,
                                         'milestone_name': milestone.name,
                                         'print_burndown': False,
                                         'effort_units': self.unit_value,
-                                        'approx_start_date': approx_start_date,
+                                        'burndown_bundle_url':
+                                            BurndownBundle(self.env).url(req),
                                       })
                                        
 
@@ -100,6 +208,9 @@ class BurnDownCharts(Component):
                                         tag.li(
                                             tag.a('Story Points', href=None, id_="points-metric"),
                                         ),
+                                        tag.li(
+                                            tag.a('Cumulative Flow', href=None, id_="cumulative-flow"),
+                                        ),
                                         class_="styled-dropdown fixed-max"
                                     ),
                                     class_="dropdown-toggle inline block",
@@ -111,11 +222,32 @@ class BurnDownCharts(Component):
                                     tag.i(class_="fa fa-print"),
                                 " Print Burn Down", id_="print-burndown"))
 
-                # Adds jqPlot library needed by burndown charts
-                self._add_static_files(req)
-
         return template, data, content_type
 
+    # IMilestoneChangeListener methods
+
+    def milestone_created(self, milestone):
+        del self.milestone_subtrees
+
+    def milestone_changed(self, milestone, old_values):
+        del self.milestone_subtrees
+        if 'name' in old_values:
+            SeriesCache(self.env).invalidate(old_values['name'])
+            StartDateCache(self.env).invalidate(old_values['name'])
+            self.render_cache.invalidate(old_values['name'])
+            self.downsample_cache.invalidate(old_values['name'])
+            self.forecast_cache.invalidate(old_values['name'])
+            self.flow_cache.invalidate(old_values['name'])
+
+    def milestone_deleted(self, milestone):
+        del self.milestone_subtrees
+        SeriesCache(self.env).invalidate(milestone.name)
+        StartDateCache(self.env).invalidate(milestone.name)
+        self.render_cache.invalidate(milestone.name)
+        self.downsample_cache.invalidate(milestone.name)
+        self.forecast_cache.invalidate(milestone.name)
+        self.flow_cache.invalidate(milestone.name)
+
     # IRequestHandler
 
     def match_request(self, req):
@@ -125,16 +257,22 @@ class BurnDownCharts(Component):
         that we check to see if the the milestone exists, as another 
         IRequestHandler opens a new milestone template when a user
         references a non existant milestone. Additional arguments are 
-        delt with by the process_request."""
+        delt with by the process_request.
+
+        Dashboards showing many charts can instead request /burndownchart 
+        with a milestone argument for each chart they need."""
 
         match = re.match(r'/burndownchart(?:/(.+))?$', req.path_info)
         if match:
             if match.group(1):
                 # check that the milestone exists
                 req.args['id'] = match.group(1)
-                milestone = self._get_milestone(req)
-                if milestone:
+                if self.get_context(req):
                     return True
+            elif 'milestone' in req.args:
+                # /burndownchart?milestone=a&milestone=b returns the charts
+                # for several milestones at once
+                return True
 
     def process_request(self, req):
         """Collect the data needed for a burndown chart and pass to JavaScript. 
@@ -146,11 +284,15 @@ class BurnDownCharts(Component):
         the 1st December, that were 20 open tickets at the end of that day.
         """
 
-        # Get milestone object and all child milestones
-        # we already know it exists, as we checked in the match_request()
-        milestone = Milestone(self.env, req.args['id'])
-        tree = Milestone.build_tree(self.env)
-        all_milestones = [m.name for m in tree.find(milestone.name).traverse()]
+        if 'id' not in req.args:
+            return self._process_batch_request(req)
+
+        # Get the milestone and the context we created for it in 
+        # match_request(), as we already know it exists
+        context = self.get_context(req)
+        milestone = context.milestone
+        req.perm(milestone.resource).require('MILESTONE_VIEW')
+        timer = self.get_timer(req)
 
         # If anyone request burndownchart/milestone_id not via AJAX
         # and not with a format argument (eg when printing) , we redirect to 
@@ -159,32 +301,57 @@ class BurnDownCharts(Component):
         if not XMLHttp and 'format' not in req.args:
             req.redirect(req.href.milestone(milestone.name))
 
-        # Calculate series of dates used to render the burn down charts
-        start = self.get_start_date(req, milestone)
-        end = self.get_end_date(milestone)
-        day_before_start = start - timedelta(days=1)
-        dates = self.dates_inbetween(day_before_start, end)
+        # No milestone start or estimated start date, so there is no chart
+        if context.start is None:
+            format = req.args.get('format')
+            if format in ('svg', 'png'):
+                self._send_message_image(req, 'No tickets were associated '
+                                         'with this milestone yesterday.',
+                                         format)
+            data = {'result': False, 'no_start_date': True}
+            if XMLHttp:
+                req.send(to_json(data), 'text/json')
+            else:
+                return 'burndown_print.html', data, None
 
         # Open a database connection
         self.log.debug('Connecting to the database to retrieve chart data')
         db = self.env.get_read_db()
 
         # If no metric data is posted, use the project default self.unit_value
-        metric = req.args.get('metric', self.unit_value)
+        # If the metric is 'all', data for every metric is returned at once
+        # so the chart can switch between them without another request
+        metric = self._get_metric(req)
+        format = req.args.get('format')
 
-        # Remaining Effort (aka burndown) Curve
-        remaining_effort_args = [db, all_milestones, day_before_start, end]
+        # The print friendly page is just the chart image
+        if format == 'print':
+            return self._print_page(req, context, metric)
 
-        burndown_series = []
-        if metric == 'tickets':
-            burndown_series = self.tickets_open_between_dates(*remaining_effort_args)
-        elif metric == 'hours':
-            burndown_series = self.hours_remaining_between_dates(*remaining_effort_args)
-        elif metric == 'points':
-            burndown_series = self.points_remaining_between_dates(*remaining_effort_args)
+        with timer.phase('tree') as phase:
+            phase.rows = len(context.milestone_names)
+
+        # Nothing has changed since the browser last asked for this chart
+        if XMLHttp or format in ('svg', 'png'):
+            with timer.phase('validate'):
+                version, last_snapshot = self._check_modified(req, db,
+                                                              [context],
+                                                              metric)
+
+        if format in ('svg', 'png'):
+            self._send_image(req, db, context, metric, format, version)
+
+        # The cumulative flow chart shows every status, not just the 
+        # remaining effort
+        if XMLHttp and req.args.get('chart') == 'flow':
+            self._send_flow(req, db, context, metric, version, timer)
+
+        burndown = self.burndown_series(db, context, self._metrics_for(metric))
+        with timer.phase('chart'):
+            data = self.chart_data(context, metric, burndown)
 
         # If we don't have any burndown data send a message and stop
-        if not burndown_series:
+        if data is None:
             data = {'result': False}
             # For ajax request
             if XMLHttp:
@@ -192,32 +359,6 @@ class BurnDownCharts(Component):
             else:
                 return 'burndown_print.html', data, None
 
-        # Team Effort Curve
-        team_effort = self.team_effort_curve(db, metric, all_milestones,
-                                                day_before_start, end,
-                                                self.dates_as_strings(dates))
-
-        # Ideal Curve (unit value doesnt matter)
-        if self.ideal_value == 'fixed':
-            original_estimate = burndown_series[0][1]
-
-        ideal_data = self.ideal_curve(original_estimate, day_before_start, 
-                                      self.get_due_date(milestone))
-
-        data = {
-            'burndowndata': burndown_series,
-            'teameffortdata' : team_effort,
-            'idealcurvedata': ideal_data,
-            'milestone_name': milestone.name,
-            'start_date': str(day_before_start),
-            'effort_units': metric,
-            'yaxix_label': metric.title(),
-            'result' : True,
-        }
-
-        # we need some logic to work out the end date on the xAxis
-        data['due_date'] =  (self.get_due_date(milestone)).strftime("%Y-%m-%d")
-
         # Ajax request
         if XMLHttp:
             kwargs = { 'daysback':0,
@@ -229,27 +370,572 @@ class BurnDownCharts(Component):
               'timeline_url': req.href.timeline(kwargs),
               'print_burndown': False,
               'render_burndown': True,
+              'approx_start_date': not milestone.start
+                                   and str(context.day_before_start),
             })
 
-            req.send(to_json(data), 'text/json')
+            # The browser keeps the last data it received, and can ask for
+            # just the days after the last snapshot it has. If the version
+            # changed, the start date, due date or milestone tree did too,
+            # so all days are sent again.
+            data['version'] = md5(repr(self.chart_version([context],
+                                                          metric))).hexdigest()
+            data['last_day'] = last_snapshot and str(last_snapshot)
+            data['delta'] = False
+
+            self._add_forecast(db, data, milestone.name, metric, version,
+                               timer)
+
+            # Long milestones have more days than the chart can show, so 
+            # the browser can ask for fewer points. The downsampled series
+            # can't be merged with stored data, so they are sent in full.
+            max_points = as_int(req.args.get('max_points'), None, min=3)
+            if max_points:
+                self._downsample_series(data, milestone.name, metric,
+                                        version, max_points, timer)
+
+            since = req.args.get('since')
+            if since and req.args.get('version') == data['version'] \
+                    and not data.get('downsampled'):
+                try:
+                    datetime.strptime(since, '%Y-%m-%d')
+                except ValueError:
+                    pass
+                else:
+                    self._series_after(data, since)
+                    data['delta'] = True
+
+            if req.args.get('compact') and not data.get('downsampled'):
+                self._compact_series(data)
 
-        # Normal request (eg the print friendly page)
+            self._send_json(req, data, timer, milestone=milestone.name,
+                            metric=metric)
+
+    # Other methods for the class
+    def _process_batch_request(self, req):
+        """Returns the chart data for every milestone named in the 
+        milestone arguments as a single JSON document, keyed by milestone 
+        name. Milestones which don't exist, can't be viewed or have no 
+        data are left out.
+
+        The series for all of the milestones are calculated together, see
+        burndown_series_batch()."""
+
+        names = set(req.args.getlist('milestone'))
+        metric = self._get_metric(req)
+
+        # The milestones are taken from the shared milestone hierarchy, so
+        # none of them need to be loaded from the database
+        contexts = []
+        for milestone in self.milestone_subtrees.milestones(names):
+            if 'MILESTONE_VIEW' not in req.perm(milestone.resource):
+                continue
+            context = self.context_for_milestone(req, milestone)
+            if context:
+                contexts.append(context)
+
+        timer = self.get_timer(req)
+        with timer.phase('tree') as phase:
+            phase.rows = sum(len(context.milestone_names)
+                             for context in contexts)
+
+        db = self.env.get_read_db()
+        with timer.phase('validate'):
+            version, last_snapshot = self._check_modified(req, db, contexts,
+                                                          metric)
+        burndown = self.burndown_series_batch(db, contexts,
+                                              self._metrics_for(metric))
+
+        max_points = as_int(req.args.get('max_points'), None, min=3)
+        charts = {}
+        with timer.phase('chart'):
+            for context in contexts:
+                data = self.chart_data(context, metric,
+                                       burndown[context.milestone.name])
+                if data is not None:
+                    charts[context.milestone.name] = data
+
+        for name, data in charts.iteritems():
+            self._add_forecast(db, data, name, metric, version, timer)
+            if max_points:
+                self._downsample_series(data, name, metric, version,
+                                        max_points, timer)
+            if req.args.get('compact') and not data.get('downsampled'):
+                self._compact_series(data)
+
+        self._send_json(req, {'result': True, 'milestones': charts}, timer,
+                        milestones=len(contexts), metric=metric)
+
+    def _send_flow(self, req, db, context, metric, version, timer):
+        """Sends the cumulative flow chart data, see flow_data(). It is 
+        kept in the flow_cache until the version of the chart data 
+        changes."""
+
+        data = self.flow_cache.get(context.milestone.name, metric, version)
+        if data is None:
+            with timer.phase('flow') as phase:
+                flow = self.status_flow(db, context.milestone_names,
+                                        context.day_before_start,
+                                        context.end)
+                phase.rows = sum(len(days) for by_metric
+                                 in (flow or {}).itervalues()
+                                 for days in by_metric.itervalues())
+            with timer.phase('chart'):
+                data = self.flow_data(context, metric, flow)
+            if flow is not None:
+                self.flow_cache.set(context.milestone.name, metric, version,
+                                    data)
+
+        self._send_json(req, data, timer, milestone=context.milestone.name,
+                        metric=metric, chart='flow')
+
+    def _print_page(self, req, context, metric):
+        """Returns the print friendly page, which shows the chart as an 
+        SVG image drawn on the server and opens the print dialog once the 
+        image has loaded."""
+
+        if metric == 'all':
+            metric = self.unit_value
+
+        args = {'format': 'svg', 'metric': metric}
+
+        data = {
+            'milestone_name': context.milestone.name,
+            'image_url': req.href.burndownchart(context.milestone.name,
+                                                **args),
+            'result': True,
+        }
+        return 'burndown_print.html', data, None
+
+    def _send_image(self, req, db, context, metric, format, version):
+        """Sends the chart for a single metric as an SVG or PNG image.
+
+        Images are drawn on the server by the render module, and stored in 
+        the render cache keyed by the milestone, metric and data version, 
+        so each version of a chart is only drawn once."""
+
+        if metric == 'all':
+            metric = self.unit_value
+        self._check_image_format(format)
+
+        timer = self.get_timer(req)
+        content = self.render_cache.get(context.milestone.name, metric,
+                                        version, format)
+        if content is None:
+            burndown = self.burndown_series(db, context, [metric])
+            with timer.phase('chart'):
+                data = self.chart_data(context, metric, burndown)
+            if data is not None:
+                self._add_forecast(db, data, context.milestone.name, metric,
+                                   version, timer)
+            with timer.phase('render'):
+                if data is None:
+                    svg = render.render_message('Failed to retrieve burn '
+                                                'down data.')
+                else:
+                    svg = render.render_svg(data)
+
+                if format == 'png':
+                    content = render.svg_to_png(svg)
+                else:
+                    content = svg.encode('utf-8')
+            self.render_cache.set(context.milestone.name, metric, version,
+                                  format, content)
+
+        self._write_image(req, content, format, timer,
+                          milestone=context.milestone.name, metric=metric)
+
+    def _send_message_image(self, req, message, format):
+        """Sends an SVG or PNG image showing just the message, so pages 
+        embedding the chart as an image don't show a broken image."""
+
+        self._check_image_format(format)
+        svg = render.render_message(message)
+        if format == 'png':
+            content = render.svg_to_png(svg)
+        else:
+            content = svg.encode('utf-8')
+        self._write_image(req, content, format, self.get_timer(req))
+
+    def _check_image_format(self, format):
+        """Raises a TracError if images can't be drawn in the format."""
+
+        if format == 'png' and render.cairosvg is None:
+            raise TracError('PNG burndown charts require the cairosvg '
+                            'package. Use format=svg instead.')
+
+    def _write_image(self, req, content, format, timer, **details):
+        """Sends the content of an SVG or PNG image as the response."""
+
+        req.send_response(200)
+        req.send_header('Cache-Control', 'must-revalidate')
+        req.send_header('Content-Type', format == 'png' and 'image/png' or
+                                        'image/svg+xml')
+        req.send_header('Content-Length', len(content))
+        self._send_timing(req, timer, format=format, **details)
+        req.end_headers()
+        if req.method != 'HEAD':
+            req.write(content)
+        raise RequestDone
+
+    def context_for_milestone(self, req, milestone):
+        """Returns a BurndownContext for a milestone which isn't the one 
+        requested, or None if the milestone has no start date and tickets 
+        have never been assigned to it, see get_start_date()."""
+
+        context = BurndownContext(self, req, milestone)
+        if context.start is None:
+            return None
+        return context
+
+    def _check_modified(self, req, db, contexts, metric):
+        """Sends a 304 Not Modified response if the browser already has 
+        the chart data for these contexts and metric, otherwise adds the 
+        ETag and Last-Modified headers to the response. Returns a tuple of
+        a token which changes whenever the chart data changes, and the date
+        of the last history snapshot of the milestones (or None).
+
+        The chart data can only change when a new history snapshot is 
+        captured for the milestones, when the milestone dates or hierarchy 
+        change, or when the burndown or workflow configuration changes. 
+        The entity tag is made from all of these, so checking it only 
+        costs one indexed query rather than building the series.
+
+        Milestone changes don't have a modification time, so 
+        If-Modified-Since is only used when the browser doesn't send 
+        If-None-Match."""
+
+        milestone_names = sorted(set(name for context in contexts
+                                      for name in context.milestone_names))
+        last_snapshot = None
+        if milestone_names:
+            last_snapshot = self.last_snapshot_day(db, milestone_names)
+        if last_snapshot:
+            if isinstance(last_snapshot, basestring):
+                last_snapshot = datetime.strptime(last_snapshot,
+                                                  '%Y-%m-%d').date()
+            # the snapshot is captured at the end of the day
+            last_modified = datetime.combine(last_snapshot,
+                                time(hour=23, minute=59, tzinfo=utc))
         else:
-            if req.args.get('format') == 'print':
-                # Load the burn down JS file and jqPlot library 
-                add_script(req, 'burndown/js/burndown.js')
-                self._add_static_files(req)
+            last_modified = datetime.fromtimestamp(0, utc)
+        try:
+            config_modified = datetime.fromtimestamp(
+                             int(os.path.getmtime(self.config.filename)), utc)
+        except (OSError, TypeError):
+            pass
+        else:
+            last_modified = max(last_modified, config_modified)
+
+        extra = self.chart_version(contexts, metric) + \
+                [str(context.end) for context in contexts]
+
+        if_modified_since = req.get_header('If-Modified-Since')
+        if if_modified_since and not req.get_header('If-None-Match'):
+            since = parsedate_tz(if_modified_since)
+            if since and last_modified <= datetime.fromtimestamp(
+                                                mktime_tz(since), utc):
+                req.send_response(304)
+                req.send_header('Content-Length', 0)
+                req.end_headers()
+                raise RequestDone
+
+        req.send_header('Last-Modified', http_date(last_modified))
+        req.check_modified(last_modified, extra)
+
+        return (md5(repr((http_date(last_modified), extra))).hexdigest(),
+                last_snapshot)
+
+    def chart_version(self, contexts, metric):
+        """Returns a list of everything apart from the ticket history which
+        the chart data for the contexts and metric depends on. If none of 
+        it changes, new history only adds days to the end of each series.
+
+        That excludes the end date, which moves on every day."""
+
+        version = [metric, db_default.version, self.unit_value,
+                   self.day_value, self.ideal_value,
+                   sorted(self.closed_statuses_for_all_types().iteritems())]
+        for context in contexts:
+            calendar = context.calendar
+            version.append((context.milestone.name, context.milestone_names,
+                            str(context.start), str(context.due),
+                            calendar.weekdays_only,
+                            sorted(calendar.holidays)))
+        return version
+
+    def _metric_data(self, data):
+        """Returns the dictionaries holding series in the chart data, 
+        which may hold a single metric or all of them."""
+
+        return [data] + data.get('metrics', {}).values()
+
+    def _metric_data_items(self, data):
+        """Returns (name, dictionary) tuples for the dictionaries returned
+        by _metric_data(), with None as the name of the top-level data."""
+
+        return [(None, data)] + data.get('metrics', {}).items()
+
+    def _series_after(self, data, day):
+        """Removes the days up to and including day from the remaining, 
+        team effort and work added series of the chart data."""
+
+        for metric_data in self._metric_data(data):
+            for key in ('burndowndata', 'teameffortdata', 'workaddeddata'):
+                if key in metric_data:
+                    metric_data[key] = [point for point in metric_data[key]
+                                        if point[0] > day]
+
+    def _downsample_series(self, data, milestone, metric, version,
+                           max_points, timer):
+        """Reduces every series of the chart data to at most max_points,
+        see series.downsample(). The result is kept in the downsample_cache
+        until the version of the chart data changes, so it is only
+        calculated once for each new snapshot."""
+
+        downsampled = self.downsample_cache.get(milestone, metric,
+                                                (version, max_points))
+        if downsampled is None:
+            with timer.phase('downsample'):
+                downsampled = {}
+                for name, metric_data in self._metric_data_items(data):
+                    downsampled[name] = dict(
+                        (key, series.downsample(metric_data[key], max_points))
+                        for key in self.series_keys
+                        if len(metric_data.get(key) or ()) > max_points)
+            self.downsample_cache.set(milestone, metric,
+                                      (version, max_points), downsampled)
+
+        for name, metric_data in self._metric_data_items(data):
+            series_data = downsampled.get(name)
+            if series_data:
+                metric_data.update(series_data)
+                data['downsampled'] = True
+
+    def _add_forecast(self, db, data, milestone, metric, version, timer):
+        """Adds the forecast() for each metric to the chart data. The 
+        forecasts are kept in the forecast_cache until the version of the
+        chart data changes."""
+
+        key = (version, self.forecast_days, self.forecast_bands)
+        forecasts = self.forecast_cache.get(milestone, metric, key)
+        if forecasts is None:
+            with timer.phase('forecast'):
+                due = datetime.strptime(data['due_date'], '%Y-%m-%d').date()
+                forecasts = {}
+                for name, metric_data in self._metric_data_items(data):
+                    if metric_data.get('burndowndata'):
+                        forecasts[name] = self.forecast(db,
+                                                metric_data['effort_units'],
+                                                metric_data['burndowndata'],
+                                                due)
+            self.forecast_cache.set(milestone, metric, key, forecasts)
+
+        for name, metric_data in self._metric_data_items(data):
+            metric_data.update(forecasts.get(name) or {})
+
+    def _compact_series(self, data):
+        """Replaces the lists of (date, value) tuples of every series in 
+        the chart data with a start date and a list of daily values, see 
+        series.compact()."""
+
+        for metric_data in self._metric_data(data):
+            for key in self.series_keys:
+                if key in metric_data:
+                    metric_data[key] = series.compact(metric_data[key])
+        data['compact'] = True
+
+    def _send_json(self, req, data, timer, **fields):
+        """Sends the data as JSON, compressed with gzip if the browser
+        accepts it and the response is worth compressing."""
+
+        with timer.phase('json'):
+            content = to_json(data)
+            if isinstance(content, unicode):
+                content = content.encode('utf-8')
+
+        req.send_header('Vary', 'Accept-Encoding')
+        if len(content) > 1024 and \
+                'gzip' in (req.get_header('Accept-Encoding') or ''):
+            with timer.phase('gzip'):
+                buf = StringIO()
+                with GzipFile(fileobj=buf, mode='wb', compresslevel=6) as f:
+                    f.write(content)
+                content = buf.getvalue()
+            req.send_header('Content-Encoding', 'gzip')
+
+        self._send_timing(req, timer, **fields)
+        req.send(content, 'text/json')
+
+    def get_timer(self, req):
+        """Returns the PhaseTimer for the request, or a timer which does 
+        nothing if timing is disabled or there is no request."""
+
+        if req is None or not self.timing:
+            return NULL_TIMER
+        timer = getattr(req, '_burndown_timer', None)
+        if timer is None:
+            timer = req._burndown_timer = PhaseTimer()
+        return timer
+
+    def _send_timing(self, req, timer, **fields):
+        """Adds the Server-Timing header to the response and logs the 
+        phase durations, if timing is enabled."""
+
+        if not timer.enabled:
+            return
+        req.send_header('Server-Timing', timer.header())
+        self.log.info('Burndown chart timing: %s', timer.log_line(**fields))
+        self.timing_stats.add(timer)
+
+    def _get_metric(self, req):
+        """Returns the metric request argument, or self.unit_value if there
+        is none. The metric becomes part of the cache keys and file names,
+        so anything other than one of self.metrics or 'all' is rejected."""
 
-                result = {'data': data,
-                          'print_burndown': True,
-                          'render_burndown': True,
-                          'result': True,
-                         }
+        metric = req.args.get('metric', self.unit_value)
+        if metric != 'all' and metric not in self.metrics:
+            raise HTTPBadRequest("Unknown burndown chart metric '%s'" % metric)
+        return metric
 
-                add_script_data(req, result)
-                return 'burndown_print.html', result, None
+    def _metrics_for(self, metric):
+        """Returns the metrics to calculate for the metric request 
+        argument, where 'all' means every metric."""
+
+        if metric == 'all':
+            return self.metrics
+        return [metric]
+
+    def chart_data(self, context, metric, burndown):
+        """Returns the data for a chart from the dictionary of series 
+        returned by burndown_series(), or None if there is no data for 
+        any metric."""
+
+        metric_data = dict((m, self.metric_data(context, m, *burndown[m]))
+                           for m in burndown)
+        if not any(m['result'] for m in metric_data.itervalues()):
+            return None
+
+        data = {
+            'milestone_name': context.milestone.name,
+            'start_date': str(context.day_before_start),
+            'result' : True,
+        }
+
+        if metric == 'all':
+            data['metrics'] = metric_data
+            data['effort_units'] = self.unit_value
+        else:
+            data.update(metric_data[metric])
+
+        # we need some logic to work out the end date on the xAxis
+        data['due_date'] = context.due.strftime("%Y-%m-%d")
+
+        return data
+
+    def flow_data(self, context, metric, flow):
+        """Returns the data for a cumulative flow chart from the dictionary
+        returned by status_flow(). For each metric, statuses lists the
+        statuses from the bottom of the chart to the top, with closed 
+        statuses first, and flowdata maps each status to a list of 
+        (date string, value) tuples. Days without a history snapshot are
+        left out, and statuses without tickets on a day have a value of 0.
+        """
+
+        if not flow:
+            return {'result': False}
+
+        dates = context.date_strings
+        snapshot_days = set(day for by_metric in flow.itervalues()
+                            for day in by_metric['tickets'])
+        closed = set(status for type_, statuses
+                     in self.closed_statuses_for_all_types().iteritems()
+                     for status in statuses)
+        statuses = sorted(flow, key=lambda status: (status not in closed,
+                                                    status))
+
+        metric_data = {}
+        for m in self._metrics_for(metric):
+            flowdata = {}
+            for status in statuses:
+                values = series.dense(dates, flow[status][m].iteritems())
+                values = [0 if value is None and day in snapshot_days
+                          else value
+                          for day, value in zip(dates, values)]
+                flowdata[status] = series.pairs(dates, values,
+                                                skip_missing=True)
+            metric_data[m] = {
+                'statuses': statuses,
+                'flowdata': flowdata,
+                'effort_units': m,
+                'yaxix_label': m.title(),
+            }
+
+        data = {
+            'chart': 'flow',
+            'milestone_name': context.milestone.name,
+            'start_date': str(context.day_before_start),
+            'due_date': context.due.strftime("%Y-%m-%d"),
+            'result': True,
+        }
+        if metric == 'all':
+            data['metrics'] = metric_data
+            data['effort_units'] = self.unit_value
+        else:
+            data.update(metric_data[metric])
+        return data
+
+    def get_context(self, req, milestone=None):
+        """Returns the BurndownContext for this request, creating it the 
+        first time it is needed. If no milestone is passed it is loaded
+        using the id request argument. Returns None if the milestone
+        does not exist."""
+
+        context = getattr(req, '_burndown_context', None)
+        if context is None:
+            if not isinstance(milestone, Milestone):
+                milestone = self._get_milestone(req)
+                if milestone is None:
+                    return None
+            context = req._burndown_context = BurndownContext(self, req,
+                                                              milestone)
+        return context
+
+    def metric_data(self, context, metric, burndown_series, team_effort):
+        """Returns the chart data for one metric, adding the work added
+        and ideal curves to the remaining and team effort series. Both are
+        worked out from those series, so need no more queries."""
+
+        if not burndown_series:
+            return {'result': False}
+
+        work_added = self.work_added(burndown_series, team_effort)
+
+        # Ideal Curve (unit value doesnt matter)
+        original_estimate = burndown_series[0][1]
+        if self.ideal_value == 'variable':
+            # work added up to the first day is in the original estimate
+            added_after_start = [(day, value) for day, value in work_added
+                                 if day > burndown_series[0][0]]
+            ideal = self.variable_ideal_curve(original_estimate,
+                                              added_after_start,
+                                              context.day_before_start,
+                                              context.due, context.calendar)
+        else:
+            ideal = self.ideal_curve(original_estimate,
+                                     context.day_before_start,
+                                     context.due, context.calendar)
+
+        return {
+            'burndowndata': burndown_series,
+            'teameffortdata' : team_effort,
+            'workaddeddata': work_added,
+            'idealcurvedata': ideal,
+            'effort_units': metric,
+            'yaxix_label': metric.title(),
+            'result': True,
+        }
 
-    # Other methods for the class
     def _get_milestone(self, req):
         """Returns a milestone instance if one exists, or None if it
         does not."""
@@ -272,9 +958,23 @@ class BurnDownCharts(Component):
 
         We do this so we can show users useful data even if a milestone has 
         no start date.
+
+        As past snapshots never change, the date is stored in the 
+        burndown_start_date table the first time it is found, and later 
+        calls only need a primary key lookup.
         """
 
+        start_dates = StartDateCache(self.env)
         db = self.env.get_read_db()
+        try:
+            first_seen = start_dates.get(db, milestone.name)
+        except Exception:
+            db.rollback()
+            self.log.exception('Unable to query the burndown start dates')
+            first_seen = None
+        if first_seen:
+            return first_seen
+
         cursor = db.cursor()
         cursor.execute("""
             SELECT _snapshottime
@@ -287,28 +987,14 @@ class BurnDownCharts(Component):
         res = cursor.fetchone()
         if res:
             try:
-                return res[0].strftime('%Y-%m-%d')
+                first_seen = res[0].strftime('%Y-%m-%d')
             except AttributeError as e:
-                self.log(e)
-
-    def _get_jqplot(self, filename):
-        """Quick reference to the location of jqPlot files"""
-        return "common/js/jqPlot/" + filename + ".js"
-
-    def _add_static_files(self, req):
-        """Adds all the jqPlot JS files we need for the burndown charts"""
-        add_script(req, self._get_jqplot('jquery.jqplot'))
-        add_stylesheet(req, 'common/js/jqPlot/jquery.jqplot.css')
-        # excanvas is needed for IE8 support
-        add_script(req, self._get_jqplot('excanvas.min'))
-        add_script(req, self._get_jqplot('plugins/jqplot.dateAxisRenderer'))
-        add_script(req, self._get_jqplot('plugins/jqplot.highlighter'))
-        add_script(req, self._get_jqplot('plugins/jqplot.canvasTextRenderer'))
-        add_script(req, self._get_jqplot('plugins/jqplot.canvasAxisTickRenderer'))
-        add_script(req, self._get_jqplot('plugins/jqplot.canvasAxisLabelRenderer'))
-        add_script(req, self._get_jqplot('plugins/jqplot.enhancedLegendRenderer'))
-
-    def get_start_date(self, req, milestone):
+                self.log.error(e)
+            else:
+                start_dates.set(milestone.name, first_seen)
+                return first_seen
+
+    def get_start_date(self, milestone):
         """
         Returns the start date, which we use as the first coordiante 
         on the x-axis of burn down charts.
@@ -316,27 +1002,20 @@ class BurnDownCharts(Component):
         If the milestone has a start date set, we use this value.
 
         If not we try and predicate this date, so can display some useful 
-        data to users. We look to see if there is a approx_start_date var 
-        in req.arg_list. If truthy, this  date is the first time a ticket 
+        data to users. We use guess_start_date(), the first time a ticket 
         is assigned to the milestone according to the ticket_bi_historical_table.
-        See the post_process_request in this component.
+        The date is never taken from the request, as it is part of the 
+        cached chart data. Returns None if there is no such date.
         """
 
         if milestone.start:
             return milestone.start.date()
-        elif 'approx_start_date' in req.args:
-            return datetime.strptime(req.args['approx_start_date'], '%Y-%m-%d').date() + timedelta(days=1)
-
-    def get_due_date(self, milestone):
-        """
-        Returns the due date if this attribute is set for the milestone, 
-        or the estimated end date as determinded by get_end_date().
-        """
-
-        if milestone.due:
-            return milestone.due.date()
-        else:
-            return self.get_end_date(milestone)
+        approx_start_date = self.guess_start_date(milestone)
+        if approx_start_date:
+            try:
+                return datetime.strptime(approx_start_date, '%Y-%m-%d').date() + timedelta(days=1)
+            except ValueError:
+                pass
 
     def get_end_date(self, milestone):
         """
@@ -353,11 +1032,284 @@ class BurnDownCharts(Component):
         # else we take yesterday to be the end date point for the x-axis
         return date.today() - timedelta(days=1)
 
-    def team_effort_curve(self, db, metric, milestone_names, milestone_start, end, dates):
-        """Returns a list of tuples, each representing the total number
-        of tickets closed on each day for a respective milestone. If no
-        tickets are closed, a tuple for that date will still be alongside
-        included a 0 value.
+    def burndown_series(self, db, context, metrics):
+        """Returns a dictionary keyed by metric. Each value is a tuple of 
+        two lists of (date, value) tuples, the first for the remaining 
+        effort curve and the second for the team effort curve.
+
+        See burndown_series_batch()."""
+
+        return self.burndown_series_batch(db, [context],
+                                          metrics)[context.milestone.name]
+
+    def burndown_series_batch(self, db, contexts, metrics):
+        """Returns a dictionary keyed by milestone name, where each value 
+        is the dictionary burndown_series() returns for that milestone.
+
+        Days already calculated for a milestone and metric are read from 
+        the burndown_series table, so only the days after the last cached 
+        day are calculated from the history tables. Those new days are 
+        then cached too, as long as the history capture has already run 
+        for them - until then the data for that day may still change.
+
+        All milestones are calculated together. The remaining effort for 
+        every metric comes from one query grouped by milestone and date, 
+        and the team effort from one query per metric, so asking for more 
+        milestones or metrics costs no extra table scans."""
+
+        metrics = [metric for metric in metrics if metric in self.metrics]
+        timer = self.get_timer(contexts[0].req if contexts else None)
+
+        cache = SeriesCache(self.env)
+        closed_statuses = self.closed_statuses_for_all_types()
+        statuses_key = sorted((type_, sorted(statuses))
+                              for type_, statuses
+                              in closed_statuses.iteritems())
+
+        # Work out which days of each series are already cached
+        plans = []
+        with timer.phase('cache') as cache_phase:
+            cache_phase.rows = 0
+            for context in contexts:
+                milestone_name = context.milestone.name
+                fingerprint = cache.fingerprint(sorted(context.milestone_names),
+                                                str(context.day_before_start),
+                                                statuses_key)
+                for metric in metrics:
+                    try:
+                        last_day = cache.last_day(db, milestone_name, metric,
+                                                  fingerprint)
+                        cached = []
+                        if last_day:
+                            cached = cache.load(db, milestone_name, metric,
+                                                context.day_before_start,
+                                                context.end)
+                    except Exception:
+                        db.rollback()
+                        self.log.exception('Unable to query the burndown series cache')
+                        last_day = None
+                        cached = []
+
+                    if last_day:
+                        since = last_day + timedelta(days=1)
+                    else:
+                        since = context.day_before_start
+                    plans.append((context, metric, fingerprint, last_day,
+                                  cached, since))
+                    cache_phase.rows += len(cached)
+
+        # Calculate every day which isn't cached in as few queries as we can
+        outdated = [plan for plan in plans if plan[5] <= plan[0].end]
+        remaining = team_effort = None
+        final_day = None
+        if outdated:
+            milestone_names = sorted(set(name for plan in outdated
+                                          for name in plan[0].milestone_names))
+            start = min(plan[5] for plan in outdated)
+            end = max(plan[0].end for plan in outdated)
+
+            with timer.phase('remaining') as phase:
+                remaining = self.remaining_by_milestone(db, milestone_names,
+                                                        start, end)
+                phase.rows = sum(len(by_metric['tickets']) for by_metric
+                                 in (remaining or {}).itervalues())
+            # The status changes are shared by the tickets and points
+            # metrics, and only the snapshots of tickets which changed or
+            # had work logged are read
+            effort_metrics = set(plan[1] for plan in outdated)
+            changes = work = []
+            with timer.phase('activity') as phase:
+                if effort_metrics - set(['hours']):
+                    changes = self.status_changes(db, milestone_names,
+                                                  start, end)
+                if 'hours' in effort_metrics:
+                    work = self.logged_work(db, milestone_names, start, end)
+                phase.rows = len(changes or ()) + len(work or ())
+            with timer.phase('snapshots') as phase:
+                snapshots = None
+                if changes is not None and work is not None:
+                    snapshots = self.ticket_snapshots(db, milestone_names,
+                                                      changes + work)
+                phase.rows = len(snapshots or ())
+            team_effort = {}
+            for metric in effort_metrics:
+                with timer.phase('effort.' + metric) as phase:
+                    if snapshots is None:
+                        team_effort[metric] = None
+                    else:
+                        team_effort[metric] = self.team_effort_by_milestone(
+                                                metric,
+                                                work if metric == 'hours'
+                                                else changes,
+                                                snapshots, closed_statuses)
+                    phase.rows = sum(len(days) for days
+                                     in (team_effort[metric] or {}).itervalues())
+            final_day = self.last_snapshot_day(db)
+
+        with timer.phase('series'):
+            return self._build_series(contexts, plans, remaining, team_effort,
+                                      final_day, cache)
+
+    def _build_series(self, contexts, plans, remaining, team_effort,
+                      final_day, cache):
+        """Combines the cached days with the new days calculated by 
+        burndown_series_batch() and caches the new days."""
+
+        burndown = dict((context.milestone.name, {}) for context in contexts)
+        for context, metric, fingerprint, last_day, cached, since in plans:
+            new_rows = []
+            if since <= context.end:
+                dates = context.date_strings[(since -
+                                              context.day_before_start).days:]
+                remaining_for_metric = series.merge_sum(
+                    remaining[name][metric]
+                    for name in context.milestone_names
+                    if remaining and name in remaining)
+                effort_for_metric = series.merge_sum(
+                    team_effort[metric][name]
+                    for name in context.milestone_names
+                    if team_effort[metric] and name in team_effort[metric])
+                new_rows = [(day, remaining_for_metric.get(day),
+                             effort_for_metric.get(day, 0))
+                            for day in dates]
+
+                # We must not cache anything if a query failed
+                if remaining is not None and team_effort[metric] is not None \
+                        and final_day:
+                    cache.append(context.milestone.name, metric, fingerprint,
+                                 [row for row in new_rows
+                                  if row[0] <= str(final_day)],
+                                 replace=not last_day)
+
+            rows = list(cached) + new_rows
+            burndown[context.milestone.name][metric] = (
+                [(day, value) for day, value, effort in rows
+                 if value is not None],
+                [(day, effort) for day, value, effort in rows])
+
+        return burndown
+
+    def remaining_by_milestone(self, db, milestone_names,
+                               milestone_start, end):
+        """Returns a dictionary keyed by milestone name. Each value is a 
+        dictionary keyed by metric, mapping a date string to the remaining 
+        effort of all open tickets in that milestone on that date. Returns 
+        None if the history could not be queried.
+
+        The open ticket count, remaining hours and story points of every 
+        milestone are aggregated in a single grouped pass over 
+        ticket_bi_historical, rather than querying the table once per 
+        metric or milestone. As a ticket is only in one milestone on each 
+        date, the values of several milestones can simply be added up."""
+
+        self.log.debug('Querying the database for historical remaining effort data')
+        cursor = db.cursor()
+        try:
+            cursor.execute("""
+                SELECT milestone,
+                    _snapshottime,
+                    COUNT(DISTINCT id),
+                    SUM(remaininghours),
+                    SUM(effort)
+                FROM ticket_bi_historical
+                WHERE milestone IN ({0})
+                    AND _snapshottime >=%s
+                    AND _snapshottime <=%s
+                    AND isclosed = 0
+                GROUP BY milestone, _snapshottime
+                """.format(db.parammarks(len(milestone_names))),
+                milestone_names + [milestone_start, end])
+        except Exception:
+            db.rollback()
+            self.log.exception('Unable to query the historical ticket table')
+            return None
+
+        remaining = {}
+        for milestone, snapshot, tickets, hours, points in cursor:
+            if milestone not in remaining:
+                remaining[milestone] = dict((metric, {})
+                                            for metric in self.metrics)
+            day = str(snapshot)
+            remaining[milestone]['tickets'][day] = tickets
+            remaining[milestone]['hours'][day] = hours
+            remaining[milestone]['points'][day] = points
+
+        return remaining
+
+    def status_flow(self, db, milestone_names, milestone_start, end):
+        """Returns a dictionary keyed by status. Each value is a dictionary
+        keyed by metric, mapping a date string to the tickets, remaining 
+        hours or story points in that status on that date, for all tickets
+        in the milestones. Returns None if the history could not be 
+        queried.
+
+        Every status is counted in one grouped pass over 
+        ticket_bi_historical, so milestones with many statuses don't need
+        a query per status."""
+
+        cursor = db.cursor()
+        try:
+            cursor.execute("""
+                SELECT _snapshottime,
+                    status,
+                    COUNT(DISTINCT id),
+                    SUM(remaininghours),
+                    SUM(effort)
+                FROM ticket_bi_historical
+                WHERE milestone IN ({0})
+                    AND _snapshottime >=%s
+                    AND _snapshottime <=%s
+                GROUP BY _snapshottime, status
+                """.format(db.parammarks(len(milestone_names))),
+                milestone_names + [milestone_start, end])
+        except Exception:
+            db.rollback()
+            self.log.exception('Unable to query the historical ticket table')
+            return None
+
+        flow = {}
+        for snapshot, status, tickets, hours, points in cursor:
+            if status not in flow:
+                flow[status] = dict((metric, {}) for metric in self.metrics)
+            day = str(snapshot)
+            flow[status]['tickets'][day] = tickets
+            flow[status]['hours'][day] = hours
+            flow[status]['points'][day] = points
+
+        return flow
+
+    def last_snapshot_day(self, db, milestone_names=None):
+        """Returns the date of the most recent history capture, or None if
+        the ticket_bi_historical table is empty. If milestone names are 
+        passed, only snapshots of tickets in those milestones are used."""
+
+        cursor = db.cursor()
+        try:
+            if milestone_names is None:
+                cursor.execute("""
+                    SELECT MAX(_snapshottime)
+                    FROM ticket_bi_historical
+                    """)
+            else:
+                cursor.execute("""
+                    SELECT MAX(_snapshottime)
+                    FROM ticket_bi_historical
+                    WHERE milestone IN ({0})
+                    """.format(db.parammarks(len(milestone_names))),
+                    milestone_names)
+        except Exception:
+            db.rollback()
+            self.log.exception('Unable to query the historical ticket table')
+            return None
+
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def team_effort_by_milestone(self, metric, rows, snapshots,
+                                 closed_statuses):
+        """Returns a dictionary keyed by milestone name, where each value
+        is a dictionary mapping a date string to the team effort in that 
+        milestone on that date. Dates without any effort are not included.
 
         If the metric specified is tickets, the number of tickets closed
         on that date will be used. If a ticket is reopened after it is
@@ -368,114 +1320,179 @@ class BurnDownCharts(Component):
         a given day will be used.
 
         If the metric specified is story_points, the total amount of story points 
-        for all tickets closed on that day will be used."""
+        for all tickets closed on that day will be used.
 
-        # Convert milestone start and end dates to timestamps based on metric
+        For hours the rows are those returned by logged_work(), otherwise
+        by status_changes(). Each row is matched to the history snapshot 
+        of its ticket on the same day from ticket_snapshots(), to see which 
+        milestone the ticket was in on that day."""
+
+        effort = {}
         if metric == 'hours':
-            start_stamp = to_timestamp(datetime.combine(milestone_start,
-                                        time(hour=0,minute=00,tzinfo=utc)))
-            end_stamp = to_utimestamp(datetime.combine(end,
-                                       time(hour=23,minute=59,tzinfo=utc)))
-        else: # must be tickets or story points
-            start_stamp = to_utimestamp(datetime.combine(milestone_start,
-                                            time(hour=0,minute=00,tzinfo=utc)))
-            end_stamp = to_utimestamp(datetime.combine(end,
-                                           time(hour=23,minute=59,tzinfo=utc)))
-
-        # Create a custor to access the database
+            for ticket, day, hours in rows:
+                snapshot = snapshots.get((ticket, day))
+                if snapshot:
+                    worked = effort.setdefault(snapshot[0], {})
+                    worked[day] = worked.get(day, 0) + hours
+        else:
+            # must be tickets or story points
+            changes = {}
+            for ticket, day, oldvalue, newvalue in rows:
+                snapshot = snapshots.get((ticket, day))
+                if snapshot:
+                    changes.setdefault(snapshot[0], []).append(
+                        (ticket, day, snapshot[1], oldvalue, newvalue,
+                         snapshot[2]))
+            for milestone, milestone_changes in changes.iteritems():
+                effort[milestone] = dict(self.count_tickets_closed(
+                                            milestone_changes,
+                                            closed_statuses, metric))
+
+        return effort
+
+    def _tickets_in_milestones(self, db, milestone_names):
+        """Returns a subquery for the tickets which were in one of the 
+        milestones at some point between two dates, which are passed after 
+        the milestone names.
+
+        Only changes and logged work of these tickets are read. The time
+        ranges use the indexes added in upgrades/db2.py, and the timestamps 
+        are turned into day numbers with integer division while reading 
+        the rows, so the queries run on every database Trac supports."""
+
+        return """
+            SELECT DISTINCT id
+            FROM ticket_bi_historical
+            WHERE milestone IN ({0})
+                AND _snapshottime >= %s
+                AND _snapshottime <= %s
+            """.format(db.parammarks(len(milestone_names)))
+
+    def status_changes(self, db, milestone_names, milestone_start, end):
+        """Returns a list of (ticket id, date string, old status, new 
+        status) tuples for the status changes of tickets in the milestones
+        between the dates, in the order they were made. Returns None if 
+        the history could not be queried."""
+
+        first_day = (milestone_start - date(1970, 1, 1)).days
+        day_strings = series.day_strings(milestone_start, end)
         cursor = db.cursor()
+        try:
+            cursor.execute("""
+                SELECT ticket, time, oldvalue, newvalue
+                FROM ticket_change
+                WHERE field = 'status'
+                    AND time >= %s
+                    AND time < %s
+                    AND ticket IN ({0})
+                ORDER BY time ASC
+                """.format(self._tickets_in_milestones(db, milestone_names)),
+                [first_day * 86400000000,
+                 (first_day + len(day_strings)) * 86400000000] +
+                milestone_names + [milestone_start, end])
+        except Exception:
+            db.rollback()
+            self.log.exception('Unable to query the ticket changes')
+            return None
 
-        # Get all statuses we consider to mean that the ticket is closed
-        closed_statuses, types_and_statuses = self.closed_statuses_for_all_types()
+        return [(ticket, day_strings[changed // 86400000000 - first_day],
+                 oldvalue, newvalue)
+                for ticket, changed, oldvalue, newvalue in cursor]
 
-        # These queries all rely on a join with the ticket_bi_historical
-        # table to see which tickets were in the defined milestone 
-        # on a given day
+    def logged_work(self, db, milestone_names, milestone_start, end):
+        """Returns a list of (ticket id, date string, hours) tuples for the
+        work logged against tickets in the milestones between the dates.
+        Returns None if the history could not be queried."""
+
+        first_day = (milestone_start - date(1970, 1, 1)).days
+        day_strings = series.day_strings(milestone_start, end)
+        cursor = db.cursor()
         try:
-            if metric == 'tickets':
-                cursor.execute("""
-                    SELECT c.ticket,
-                        (timestamp with time zone 'epoch' + c.time/1000000 * INTERVAL '1 second')::date as day,
-                        h.type,
-                        c.oldvalue,
-                        c.newvalue
-                    FROM ticket_change AS c
-                    JOIN ticket_bi_historical AS h
-                        ON c.ticket = h.id
-                        AND h._snapshottime = (timestamp with time zone 'epoch' + c.time/1000000 * INTERVAL '1 second')::date
-                    WHERE h.milestone IN ({0})
-                        AND c.time >= %s
-                        AND c.time <= %s
-                        AND c.field = 'status'
-                    ORDER BY c.time ASC
-                    """.format(db.parammarks(len(milestone_names))),
-                    milestone_names + [start_stamp, end_stamp])
-            elif metric == 'hours':
-                cursor.execute("""
-                    SELECT SUM(t.seconds_worked),
-                        (timestamp with time zone 'epoch' + t.time_started * INTERVAL '1 second')::date as day
-                    FROM ticket_time AS t
-                    JOIN ticket_bi_historical AS h
-                        ON t.ticket = h.id
-                        AND h._snapshottime = (timestamp with time zone 'epoch' + t.time_started * INTERVAL '1 second')::date
-                    WHERE h.milestone IN ({0})
-                        AND t.time_started >= %s
-                        AND t.time_started <= %s
-                    GROUP BY day;
-                    """.format(db.parammarks(len(milestone_names))),
-                    milestone_names + [start_stamp, end_stamp])
-            elif metric == 'points':
+            cursor.execute("""
+                SELECT ticket, time_started, seconds_worked
+                FROM ticket_time
+                WHERE time_started >= %s
+                    AND time_started < %s
+                    AND ticket IN ({0})
+                """.format(self._tickets_in_milestones(db, milestone_names)),
+                [first_day * 86400, (first_day + len(day_strings)) * 86400] +
+                milestone_names + [milestone_start, end])
+        except Exception:
+            db.rollback()
+            self.log.exception('Unable to query the logged work')
+            return None
+
+        return [(ticket, day_strings[started // 86400 - first_day],
+                 float(seconds)/60/60)
+                for ticket, started, seconds in cursor]
+
+    def ticket_snapshots(self, db, milestone_names, rows):
+        """Returns a dictionary keyed by (ticket id, date string) tuples 
+        for the history snapshots of tickets in the milestones, where each
+        value is a (milestone, type, effort) tuple. Only the snapshots for
+        the ticket and date at the start of each of the rows are read, 
+        rather than every snapshot of the milestones. Returns None if the 
+        history could not be queried."""
+
+        wanted = set((row[0], row[1]) for row in rows)
+        if not wanted:
+            return {}
+        tickets = sorted(set(ticket for ticket, day in wanted))
+        days = [day for ticket, day in wanted]
+
+        snapshots = {}
+        cursor = db.cursor()
+        try:
+            for i in xrange(0, len(tickets), self.snapshot_tickets_per_query):
+                chunk = tickets[i:i + self.snapshot_tickets_per_query]
                 cursor.execute("""
-                    SELECT h.id,
-                           h._snapshottime,
-                           h.type,
-                           c.oldvalue,
-                           c.newvalue,
-                           h.effort
-                    FROM ticket_bi_historical AS h
-                    JOIN ticket_change AS c ON h.id = c.ticket
-                        AND h._snapshottime = (timestamp with time zone 'epoch' + c.time/1000000 * INTERVAL '1 second')::date
-                    WHERE h.milestone IN ({0})
-                        AND c.time >= %s
-                        AND c.time <= %s
-                        AND c.field = 'status'
-                    ORDER BY h._snapshottime
-                    """.format(db.parammarks(len(milestone_names))),
-                    milestone_names + [start_stamp, end_stamp])
+                    SELECT id, _snapshottime, milestone, type, effort
+                    FROM ticket_bi_historical
+                    WHERE milestone IN ({0})
+                        AND _snapshottime >= %s
+                        AND _snapshottime <= %s
+                        AND id IN ({1})
+                    """.format(db.parammarks(len(milestone_names)),
+                               db.parammarks(len(chunk))),
+                    milestone_names + [min(days), max(days)] + chunk)
+                for id, snapshot, milestone, type_, effort in cursor:
+                    key = (id, str(snapshot))
+                    if key in wanted:
+                        snapshots[key] = (milestone, type_, effort)
         except Exception:
             db.rollback()
             self.log.exception('Unable to query the historical ticket table')
-            return []
+            return None
 
-        if metric == 'hours':
-            work_per_date = [(i[1].strftime('%Y-%m-%d'),
-                              float(i[0])/60/60) for i in cursor]
-        else:
-            # must be tickets or story points
-            work_per_date = self.count_tickets_closed(cursor, closed_statuses, metric)
-
-        # Add missing dates from milestone where no tickets were closed
-        set_of_dates = set([i[0] for i in work_per_date])
-        missing_dates = [(date, 0) for date in dates if date not in set_of_dates]
-
-        return work_per_date + missing_dates
+        return snapshots
 
     def closed_statuses_for_all_types(self):
-        """Returns a dictionary where the keys are tickets types and the associated
-        values are statuses from workflow status groups where closed='True'. 
+        """Returns a ClosedStatuses map where the keys are tickets types and 
+        the associated values are frozensets of statuses from workflow status
+        groups where closed='True'. 
 
         Essentially if a ticket is in one of these statuses, we consider it closed
         and from this infer that no more work is required to complete the ticket.
+
+        The workflow is only read again when the trac.ini file has been 
+        modified, so the same map is shared by all requests until then.
         """
 
+        try:
+            mtime = os.path.getmtime(self.config.filename)
+        except (OSError, TypeError):
+            mtime = None
+
+        cached = self._closed_statuses
+        if cached and mtime is not None and cached[0] == mtime:
+            return cached[1]
+
         controller = LogicaOrderController(self.env)
-        closed_statuses = controller.type_and_statuses_for_closed_statusgroups()
-        types_and_statuses = []
-        for type_, statuses in closed_statuses.iteritems():
-            types_and_statuses.append(type_)
-            types_and_statuses.extend(statuses)
+        closed_statuses = ClosedStatuses(
+                            controller.type_and_statuses_for_closed_statusgroups())
+        self._closed_statuses = (mtime, closed_statuses)
 
-        return closed_statuses, types_and_statuses
+        return closed_statuses
 
     def tickets_in_milestone(self, milestone_names, milestone_start, end):
         """Returns a dictionary where the keys are dates between the 
@@ -507,100 +1524,122 @@ class BurnDownCharts(Component):
 
         return data
 
-    def hours_remaining_between_dates(self, db, milestone_names,
-                                      milestone_start, end):
-        """Returns a list of tuples, each with a date and total remaining hours 
-        value for all open tickets in that milestone.
-
-        This data is used for the  burndown graph, if users want to show the 
-        remaining effort burndown on a daily basis for all tickets. As a result 
-        if work is added to the milestone after the start date, it is reflected 
-        in this curve.
-
-        Also note that if a ticket is closed, we consider there to be 0 remaining
-        hours of effort remaining - even if the remaining effort value on the
-        ticket suggests otherwise. This is necessary as if the ticket is closed,
-        it is implied that there is no further work to complete."""
-
-        self.log.debug('Querying the database for historical ticket hours data')
-        cursor = db.cursor()
+    def forecast(self, db, metric, burndown_series, due):
+        """Returns a dictionary with the projected completion date of the 
+        remaining effort as forecast_date, and the line from the last 
+        remaining effort to it (or to the due date, if that comes first) 
+        as forecastdata. The velocity is the slope of the least squares 
+        line through the remaining effort of the last forecast_days days.
+        There is no forecast if the remaining effort is zero or isn't 
+        going down.
+
+        If the forecast_bands option is enabled, forecast_range holds the
+        dates the remaining effort would be done by at the 90th and 10th 
+        percentile velocity of completed milestones, relative to the 
+        effort on their first day."""
+
+        forecast = {'forecastdata': [], 'forecast_date': None,
+                    'forecast_range': None}
+        last_day, remaining = burndown_series[-1]
+        if not remaining:
+            return forecast
+        last = datetime.strptime(last_day, '%Y-%m-%d').date()
+
+        first_day = str(last - timedelta(days=self.forecast_days))
+        points = [(datetime.strptime(day, '%Y-%m-%d').toordinal(), value)
+                  for day, value in burndown_series if day >= first_day]
+        fit = series.linear_fit([x for x, y in points],
+                                [y for x, y in points])
+        finish = fit and self.forecast_finish(last, remaining, -fit[0])
+        if finish:
+            velocity = -fit[0]
+            end = finish if due <= last else min(finish, due)
+            forecast['forecast_date'] = str(finish)
+            forecast['forecastdata'] = [
+                (last_day, remaining),
+                (str(end), max(0, remaining - velocity * (end - last).days))]
+
+        estimate = burndown_series[0][1]
+        if self.forecast_bands and estimate:
+            velocities = self.historical_velocities(db, metric)
+            if velocities:
+                dates = [self.forecast_finish(last, remaining,
+                                              velocity * estimate)
+                         for velocity in (series.percentile(velocities, 90),
+                                          series.percentile(velocities, 10))]
+                if all(dates):
+                    forecast['forecast_range'] = [str(d) for d in dates]
+
+        return forecast
+
+    def forecast_finish(self, last, remaining, velocity):
+        """Returns the date the remaining effort is done by at the velocity,
+        counting from the last date. Returns None if the velocity is too 
+        small to finish within max_forecast_days."""
+
+        if velocity < self.min_forecast_velocity:
+            return None
+        days = ceil(remaining / velocity)
+        if days > self.max_forecast_days:
+            return None
         try:
-            cursor.execute("""
-                SELECT _snapshottime,
-                    SUM(remaininghours)
-                FROM ticket_bi_historical
-                WHERE milestone IN ({0})
-                    AND _snapshottime >=%s
-                    AND _snapshottime <=%s
-                    AND isclosed = 0
-                GROUP BY _snapshottime
-                ORDER BY _snapshottime ASC
-                """.format(','.join(('%s',)*len(milestone_names))), milestone_names + [milestone_start, end])
-        except Exception:
-            db.rollback()
-            self.log.exception('Unable to query the historical ticket table')
-            return []
-
-        return [(str(i[0]), i[1]) for i in cursor]
+            return last + timedelta(days=int(days))
+        except OverflowError:
+            return None
+
+    def historical_velocities(self, db, metric):
+        """Returns a sorted list of the velocity of each completed 
+        milestone, as the fraction of the effort on its first day which was
+        completed each day. The remaining effort comes from the 
+        burndown_series cache, so only milestones whose charts have been 
+        drawn are included. The list is worked out once a day."""
+
+        today = date.today()
+        velocities = self.forecast_cache.get(None, metric, today)
+        if velocities is not None:
+            return velocities
 
-    def tickets_open_between_dates(self, db, milestone_names,
-                                  milestone_start, end):
-        """Returns a list of tuples, each with a date and value to represent 
-        the total amount of tickets open for that milestone on a given date.
-
-        This is primarily designed so we can draw the remaining effort curve
-        on the burndown chart. The first tuple will always represent the first 
-        day of the milestone."""
-
-        self.log.debug('Querying the database for historical tickets open data')
-        cursor = db.cursor()
         try:
+            cursor = db.cursor()
             cursor.execute("""
-                SELECT _snapshottime, COUNT(DISTINCT id)
-                FROM ticket_bi_historical
-                WHERE milestone IN ({0})
-                    AND _snapshottime >=%s
-                    AND _snapshottime <=%s
-                    AND isclosed = 0
-                GROUP BY _snapshottime
-                ORDER BY _snapshottime ASC
-                """.format(','.join(('%s',)*len(milestone_names))), milestone_names + [milestone_start, end])
+                SELECT s.milestone, s.day, s.remaining
+                FROM burndown_series AS s
+                JOIN milestone AS m ON m.name = s.milestone
+                WHERE s.metric = %s
+                    AND m.completed > 0
+                    AND s.remaining IS NOT NULL
+                ORDER BY s.milestone, s.day
+                """, [metric])
+            rows = cursor.fetchall()
         except Exception:
             db.rollback()
-            self.log.exception('Unable to query the historical ticket table')
+            self.log.exception('Unable to query the velocity of completed '
+                               'milestones')
             return []
 
-        return [(str(i[0]), i[1]) for i in cursor]
-
-    def points_remaining_between_dates(self, db, milestone_names,
-                                       milestone_start, end):
-        """"""
-
-        self.log.debug('Querying the database for historical effort/story point data')
-        cursor = db.cursor()
-        try:
-            cursor.execute("""
-                SELECT _snapshottime, SUM(effort)
-                FROM ticket_bi_historical
-                WHERE milestone IN ({0})
-                    AND _snapshottime >=%s
-                    AND _snapshottime <=%s
-                    AND isclosed = 0
-                GROUP BY _snapshottime
-                """.format(db.parammarks(len(milestone_names))),
-                milestone_names + [milestone_start, end])
-        except Exception:
-            db.rollback()
-            self.log.exception('Unable to query the historical ticket table')
-            return []
-
-        return [(str(i[0]), i[1]) for i in cursor]
+        velocities = []
+        for milestone, days in groupby(rows, itemgetter(0)):
+            days = list(days)
+            first, last = days[0], days[-1]
+            length = (datetime.strptime(last[1], '%Y-%m-%d') -
+                      datetime.strptime(first[1], '%Y-%m-%d')).days
+            if first[2] and length > 0 and last[2] < first[2]:
+                velocities.append(float(first[2] - last[2]) / first[2] /
+                                  length)
+        velocities.sort()
+        self.forecast_cache.set(None, metric, today, velocities)
+        return velocities
 
     def work_added(self, effort_data, logged_data):
         """To calculate the amount of work added each day we find the 
         difference between the remaining effort data points on days n 
         and n-1. We then add the work logged on day n to calculate the 
-        amount of work added (or removed)."""
+        amount of work added (or removed).
+
+        Both arguments are lists of (date, value) tuples. The logged data 
+        should include every date, as the team effort curve does. Days 
+        missing from the effort data keep the remaining effort of the day 
+        before, and days before the first remaining effort are left out."""
 
         # Work can be added by:
         # * creating a new ticket in the milestone
@@ -608,21 +1647,11 @@ class BurnDownCharts(Component):
         # * increases the remaining estimated effort / story points
         # Luckily we don't need to worry about that with this algorithm
 
-        remaining_difference = [(data[0], 0) if i == 0
-                                else (data[0], data[1] - effort_data[i-1][1])
-                                for i, data
-                                in enumerate(sorted(effort_data, key=itemgetter(0)))]
-
-        # We assume that the remaining_difference and logged data are 
-        # the same length, so each tuple we iterate over in each list
-        # relates to the same date (hence the sort)
-
-        # Note that if the remaining diff is negative, we use zero value
-        # see https://d4.define.logica.com/ticket/3727
-
-        return [(remaining[0], max(0, remaining[1] + logged[1]))
-                for remaining, logged
-                in zip(remaining_difference,sorted(logged_data, key=itemgetter(0)))]
+        dates = sorted(day for day, value in logged_data)
+        return series.pairs(dates,
+                            series.work_added(series.dense(dates, effort_data),
+                                              series.dense(dates, logged_data)),
+                            skip_missing=True)
 
     def dates_inbetween(self, start, end):
         """Returns a list of datetime objects, with each item 
@@ -630,97 +1659,72 @@ class BurnDownCharts(Component):
 
         return [start + timedelta(days=i) for i in xrange((end - start).days + 1)]
 
-    def get_date_values(self, all_dates):
-        """Returns all working and non-working days in a milestone.
+    def calendar_for(self, milestone_name=None):
+        """Returns the WorkingCalendar for a milestone. Weekends are only 
+        working days if the days option is 'all', and the project holidays 
+        are never working days. If the milestone uses any team calendars, 
+        the holidays of those teams are not working days either."""
 
-        The day before the start date is always included in list list and 
-        considered a working day. We need to take this assumption otherwise 
-        the ideal curve would not decrease by the end of milestone start date. 
-        """
+        holidays = list(self.holidays)
+        if milestone_name is not None:
+            for name, team_holidays, milestones \
+                    in team_calendars(self.calendars_section):
+                if milestone_name in milestones:
+                    holidays.extend(team_holidays)
 
-        if self.day_value == 'all':
-            working_dates = all_dates[:]
-            non_working_dates = []
-        elif self.day_value == 'weekdays':
-            working_dates, non_working_dates = self.working_days(all_dates)
-        elif self.day_value == 'custom':
-            working_dates, non_working_dates = self.working_days(all_dates,
-                                                            blacklisted_dates)
-
-        # we always want the day before the milestone starts to be a working day
-        # regardless if it is a weekday or weekend
-        # if it was a non working day the ideal effort curve would not decrease
-        # by the end of the actual start date
-        day_before = all_dates[0]
-        if day_before not in working_dates:
-            non_working_dates.remove(day_before)
-            working_dates.insert(0, day_before)
-        # else it must be in working dates already
-
-        return working_dates, non_working_dates
-
-    def working_days(self, dates, blacklisted_dates=None):
-        """Expects a list of datetime objects, and if no blacklisted_dates 
-        are passed removes any dates which fall on a Saturday or Sunday. 
-
-        If blacklisted_dates is provided, all dates also in the dates 
-        list are removed (note dates which fall on saturday or sunday have
-        to be explicitly included in the blacklisted_dates list).
-
-        Returns two lists, the first listing all working day and the second
-        containing all non working days."""
-
-        if not blacklisted_dates:
-            work_dates = [date2 for date2 in dates if date2.weekday() < 5]
-        else:
-            work_dates = [date2 for date2 in dates \
-                          if date2 not in set(blacklisted_dates)]
-        non_working_dates = [date2 for date2 in dates \
-                            if date2 not in set(work_dates)]
+        return get_calendar(self.day_value == 'weekdays',
+                            parse_dates(holidays)[0])
+
+    def working_day_mask(self, start, length, calendar=None):
+        """Returns a list of booleans, one for each day from the start date,
+        which are True for working days according to the calendar (or the
+        project calendar if none is given).
 
-        return work_dates, non_working_dates
+        The first day is always a working day, as it is the day before the
+        milestone starts. If it was a non working day the ideal effort curve
+        would not decrease by the end of the actual start date."""
 
-    def ideal_curve(self, original_estimate, start, due):
+        if calendar is None:
+            calendar = self.calendar_for()
+
+        working = calendar.mask(start, length)
+        if working:
+            working[0] = True
+        return working
+
+    def ideal_curve(self, original_estimate, start, due, calendar=None):
         """Returns the average amount of work needed to remain on each day
         if the team is to finish all the work in a milestone/sprint by the
-        due date, taking into account non working days.
+        due date, taking into account non working days in the calendar
+        (or the project calendar if none is given).
 
         The first date is always one day before the actual milestone start 
         date, so users can see how much work was performed between the end 
         of the day before the milestone started, and the end of the first
         actual day. 
 
-        Also calls the dates_as_strings method first so the returned list 
-        can be passed straight to JSON."""
+        The returned list of (date string, value) tuples can be passed 
+        straight to JSON."""
 
         # we count the day before as milestone date, but a non working one
-        dates = self.dates_inbetween(start, due)
-        working_dates, non_work_dates = self.get_date_values(dates)
+        dates = series.day_strings(start, due)
+        working = self.working_day_mask(start, len(dates), calendar)
 
-        try:
-            work_per_day = float(original_estimate) / (len(working_dates) - 1)
-        except ZeroDivisionError:
-            # the milestone is only 1 day long
-            work_per_day = original_estimate
-
-        working_dates_str = self.dates_as_strings(working_dates)
-        ideal_data = []
-        work_days = 0
-        # we set ideal_for_date and last_day_amount to original estimate
-        # to handle cases when the first day in the milestone is a weekend
-        ideal_for_date = last_day_amount = original_estimate
-
-        for date in self.dates_as_strings(dates):
-            if date in set(working_dates_str):
-                ideal_for_date = original_estimate - (work_per_day*work_days)
-                ideal_data.append((date, ideal_for_date))
-                work_days += 1
-            else:
-                ideal_data.append((date, last_day_amount))
+        return series.pairs(dates, series.ideal(original_estimate, working))
 
-            last_day_amount = ideal_for_date
+    def variable_ideal_curve(self, original_estimate, work_added, start,
+                             due, calendar=None):
+        """Returns the ideal curve like ideal_curve(), but with the work 
+        added each day, as (date string, value) tuples, shared between 
+        the working days left. This is used when the [burndown] ideal 
+        option is variable."""
 
-        return ideal_data
+        dates = series.day_strings(start, due)
+        working = self.working_day_mask(start, len(dates), calendar)
+
+        return series.pairs(dates, series.variable_ideal(
+                                    original_estimate, working,
+                                    series.dense(dates, work_added, 0)))
 
     def count_tickets_closed(self, cursor, closed_statuses, metric):
         """This is used to render the work logged curve, and counts 
@@ -728,50 +1732,51 @@ class BurnDownCharts(Component):
         status on a given day. If a ticket is re-opened
         after it has already been closed on a day, we will
         no longer count that ticket as closed for the purposes
-        of this count.
+        of this count. Each day is counted on its own, so a ticket
+        closed on one day and re-opened on a later day still counts
+        towards the day it was closed.
+
+        For the tickets metric each closed ticket counts as one, and for 
+        the points metric as its story point (effort) value.
+
+        The cursor rows must be ordered by date and then by the time of 
+        the change. They are consumed one at a time, keeping only the 
+        tickets closed so far on the current date in memory.
 
         # change[0] is ticket id
         # change[1] is date changed
         # change[2] is ticket type
         # change[3] is old status value
         # change[4] is new status value
-        # change[5] is effort value (only for story point metric)"""
+        # change[5] is effort value (only for story point metric)
+
+        closed_statuses is a ClosedStatuses map, see 
+        closed_statuses_for_all_types()."""
+
+        if metric == 'points':
+            weight = lambda change: change[5] or 0
+        else:
+            weight = lambda change: 1
 
         # Group changes by date
         closed_per_date = []
         for date, changes in groupby(cursor, itemgetter(1)):
-            closed_ids = []
-            effort = {}
+            # ticket id to weight for tickets closed on this date
+            closed = {}
             for change in changes:
-                # Get all closed statuses for ticket type
-                closed_status_for_type = closed_statuses[change[2]]
+                was_closed = closed_statuses.is_closed(change[2], change[3])
+                is_closed = closed_statuses.is_closed(change[2], change[4])
 
                 # if moved from an open to closed status
-                if change[3] not in closed_status_for_type and change[4] in closed_status_for_type:
-                    closed_ids.append(change[0])
-
-                    # keep track of story point values for each ticket
-                    if len(change) >= 6 and change[0] not in effort:
-                        # use id for key, points for the value
-                        effort[change[0]] = change[5]
-
+                if is_closed and not was_closed:
+                    closed[change[0]] = weight(change)
                 # if moved from a closed status to open
-                if change[3] in closed_status_for_type and change[4] not in closed_status_for_type:
-                    # remove id from our list and story points from effort
-                    try:
-                        closed_ids.remove(change[0])
-                        del effort[change[0]]
-                    except (ValueError, KeyError):
-                        # we don't catch worry about these exceptions as
-                        # sometimes the ticket wont be in closed_ids or effort
-                        pass
-
-            if metric =='tickets':
-                # List of tuples (date, closed_count)
-                closed_per_date.append((date.strftime('%Y-%m-%d'), len(closed_ids)))
-            elif metric == 'story_points':
-                # List of tuples (date, total of effort for all closed tickets)
-                closed_per_date.append((date.strftime('%Y-%m-%d'), sum(effort.values())))
+                elif was_closed and not is_closed:
+                    closed.pop(change[0], None)
+
+            # List of tuples (date, total weight of closed tickets)
+            closed_per_date.append((str(date),
+                                    sum(closed.itervalues())))
 
         return closed_per_date
 
@@ -790,7 +1795,8 @@ class BurnDownCharts(Component):
 
     # ITemplateStreamFilter
     def filter_stream(self, req, method, filename, stream, data):
-        if re.match('/milestone/[^ ]', req.path_info):
+        # only milestone pages marked by post_process_request() show a chart
+        if getattr(req, '_burndown_chart', False):
             help_page_url = req.href.help('DefineGuide', 'DefineAgile', 'BurndownCharts')
             stream = stream | Transformer("//*[@id='milestone-overview']").after(tag(
                                                                                     tag.h2("Burn Down Chart ", 
@@ -798,7 +1804,9 @@ class BurnDownCharts(Component):
                                                                                             tag.i(class_="fa fa-question-circle color-muted", id_="burndown_more_info"),
                                                                                         href=help_page_url, target="_blank")
                                                                                         ), 
-                                                                                    tag.div(id_='milestone-burndown', class_='milestone-info')
+                                                                                    tag.div(id_='milestone-burndown', class_='milestone-info'),
+                                                                                    tag.script(Markup(BurndownBundle(self.env).loader),
+                                                                                               type='text/javascript')
                                                                                     )
                                                                                 )
 
@@ -823,7 +1831,51 @@ class BurnDownCharts(Component):
         pass
 
     def environment_needs_upgrade(self, db):
-        pass
+        """The environment also needs upgrading when a table from another
+        plugin has been created since the last upgrade, so it can be 
+        indexed."""
+
+        if self._get_schema_version(db) < db_default.version:
+            return True
+        return bool(missing_indexes(self.env, db.cursor()))
 
     def upgrade_environment(self, db):
-        pass
+        """Each schema version has its own upgrade module, named 
+        upgrades/dbN.py, where 'N' is the version number. Any index 
+        which is still missing afterwards is then created."""
+
+        cursor = db.cursor()
+        dbver = self._get_schema_version(db)
+        for i in range(dbver + 1, db_default.version + 1):
+            name = 'db%i' % i
+            try:
+                upgrades = __import__('upgrades', globals(), locals(), [name], 1)
+                script = getattr(upgrades, name)
+            except AttributeError:
+                raise TracError("No upgrade module for burndown version %i "
+                                "(%s.py)" % (i, name))
+            script.do_upgrade(self.env, i, cursor)
+            if i == 1:
+                cursor.execute("""
+                    INSERT INTO system (name, value)
+                    VALUES (%s, %s)
+                    """, [db_default.name, i])
+            else:
+                cursor.execute("""
+                    UPDATE system
+                    SET value = %s
+                    WHERE name = %s
+                    """, [i, db_default.name])
+            self.log.info('Upgraded burndown schema from version %d to %d',
+                          i - 1, i)
+        create_missing_indexes(self.env, cursor)
+
+    def _get_schema_version(self, db):
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT value
+            FROM system
+            WHERE name = %s
+            """, [db_default.name])
+        row = cursor.fetchone()
+        return int(row[0]) if row else 0
@@ -0,0 +1,354 @@
+import os
+from datetime import datetime
+from hashlib import md5
+
+
+class SeriesCache(object):
+    """Persistent store of the per-day remaining effort and team effort
+    values for a milestone tree and metric, kept in the burndown_series
+    table.
+
+    History is captured once a day and past snapshots never change, so
+    once a day has been calculated it is written here and never queried
+    again. Only the days after the last cached day are calculated on
+    later requests."""
+
+    def __init__(self, env):
+        self.env = env
+        self.log = env.log
+
+    def fingerprint(self, *parts):
+        """Returns a hash of everything the cached rows were calculated
+        from. If any part changes (eg the subtree or the start date) the
+        rows for that series are discarded."""
+
+        return md5(repr(parts)).hexdigest()
+
+    def last_day(self, db, milestone, metric, fingerprint):
+        """Returns the last cached day as a date object, or None if
+        nothing valid has been cached for this series."""
+
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT fingerprint, last_day
+            FROM burndown_series_state
+            WHERE milestone = %s
+                AND metric = %s
+            """, [milestone, metric])
+
+        row = cursor.fetchone()
+        if row and row[0] == fingerprint and row[1]:
+            return datetime.strptime(row[1], '%Y-%m-%d').date()
+
+    def load(self, db, milestone, metric, start, end):
+        """Returns a list of (date string, remaining, team effort) tuples
+        for each cached day between start and end."""
+
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT day, remaining, team_effort
+            FROM burndown_series
+            WHERE milestone = %s
+                AND metric = %s
+                AND day >= %s
+                AND day <= %s
+            ORDER BY day ASC
+            """, [milestone, metric, str(start), str(end)])
+
+        return cursor.fetchall()
+
+    def append(self, milestone, metric, fingerprint, rows, replace=False):
+        """Stores rows of (date string, remaining, team effort) tuples and
+        records the last stored day against the fingerprint.
+
+        If replace is True the rows cover the whole series and anything
+        already cached for it is removed first. Otherwise the rows are
+        only added if the cached series still has the same fingerprint.
+        Failing to write the cache is not fatal, as the caller already
+        holds the values it needs to render the chart."""
+
+        if not rows:
+            return
+
+        try:
+            with self.env.db_transaction as db:
+                cursor = db.cursor()
+                if replace:
+                    cursor.execute("""
+                        DELETE FROM burndown_series
+                        WHERE milestone = %s
+                            AND metric = %s
+                        """, [milestone, metric])
+                else:
+                    cursor.execute("""
+                        SELECT fingerprint
+                        FROM burndown_series_state
+                        WHERE milestone = %s
+                            AND metric = %s
+                        """, [milestone, metric])
+                    row = cursor.fetchone()
+                    if not row or row[0] != fingerprint:
+                        # another request rebuilt the series meanwhile
+                        return
+                    cursor.execute("""
+                        DELETE FROM burndown_series
+                        WHERE milestone = %s
+                            AND metric = %s
+                            AND day >= %s
+                        """, [milestone, metric, rows[0][0]])
+
+                cursor.executemany("""
+                    INSERT INTO burndown_series
+                        (milestone, metric, day, remaining, team_effort)
+                    VALUES (%s, %s, %s, %s, %s)
+                    """, [(milestone, metric) + tuple(row) for row in rows])
+
+                cursor.execute("""
+                    DELETE FROM burndown_series_state
+                    WHERE milestone = %s
+                        AND metric = %s
+                    """, [milestone, metric])
+                cursor.execute("""
+                    INSERT INTO burndown_series_state
+                        (milestone, metric, fingerprint, last_day)
+                    VALUES (%s, %s, %s, %s)
+                    """, [milestone, metric, fingerprint, rows[-1][0]])
+        except Exception:
+            self.log.warning('Unable to cache burndown series for %s',
+                             milestone, exc_info=True)
+
+    def invalidate(self, milestone):
+        """Removes all cached series for a milestone."""
+
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute("""
+                DELETE FROM burndown_series
+                WHERE milestone = %s
+                """, [milestone])
+            cursor.execute("""
+                DELETE FROM burndown_series_state
+                WHERE milestone = %s
+                """, [milestone])
+
+
+class MilestoneSubtrees(object):
+    """Wraps the milestone hierarchy returned by Milestone.build_tree(),
+    remembering the names of each milestone and its descendants once they
+    have been resolved.
+
+    Instances are shared between requests, and replaced whenever a
+    milestone is created, changed or deleted."""
+
+    def __init__(self, tree):
+        self.tree = tree
+        self._names = {}
+
+    def names(self, milestone):
+        """Returns a list with the name of the milestone and the names of
+        all milestones below it in the hierarchy."""
+
+        try:
+            return self._names[milestone]
+        except KeyError:
+            names = [m.name for m in self.tree.find(milestone).traverse()]
+            self._names[milestone] = names
+            return names
+
+    def milestones(self, names):
+        """Returns the milestones in the hierarchy with any of the names,
+        in the order they appear in the hierarchy."""
+
+        names = set(names)
+        return [m for m in self.tree.traverse() if m.name in names]
+
+
+class ClosedStatuses(object):
+    """Immutable map of ticket type to the frozenset of statuses from
+    workflow status groups where closed='True'.
+
+    Looking up a type the workflow doesn't know about returns an empty
+    frozenset, so every status is considered open for that type."""
+
+    __slots__ = ('_statuses',)
+
+    def __init__(self, closed_statuses):
+        self._statuses = dict((type_, frozenset(statuses))
+                              for type_, statuses
+                              in closed_statuses.iteritems())
+
+    def __getitem__(self, type_):
+        return self._statuses.get(type_, frozenset())
+
+    def __contains__(self, type_):
+        return type_ in self._statuses
+
+    def __iter__(self):
+        return iter(self._statuses)
+
+    def __len__(self):
+        return len(self._statuses)
+
+    def iteritems(self):
+        return self._statuses.iteritems()
+
+    def is_closed(self, type_, status):
+        """Returns True if the status is a closed status for the type."""
+
+        return status in self[type_]
+
+
+class StartDateCache(object):
+    """Persistent store of the first day a ticket was assigned to each
+    milestone, kept in the burndown_start_date table.
+
+    Past snapshots never change, so once a milestone has been seen in the
+    history the date can be looked up by primary key rather than scanning
+    ticket_bi_historical."""
+
+    def __init__(self, env):
+        self.env = env
+        self.log = env.log
+
+    def get(self, db, milestone):
+        """Returns the first seen date string for the milestone, or None if
+        it hasn't been stored yet."""
+
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT first_seen
+            FROM burndown_start_date
+            WHERE milestone = %s
+            """, [milestone])
+
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def set(self, milestone, first_seen):
+        """Stores the first seen date string for the milestone. Another 
+        request may have stored it first, which is not an error."""
+
+        try:
+            with self.env.db_transaction as db:
+                cursor = db.cursor()
+                cursor.execute("""
+                    DELETE FROM burndown_start_date
+                    WHERE milestone = %s
+                    """, [milestone])
+                cursor.execute("""
+                    INSERT INTO burndown_start_date (milestone, first_seen)
+                    VALUES (%s, %s)
+                    """, [milestone, first_seen])
+        except Exception:
+            self.log.warning('Unable to store the start date for %s',
+                             milestone, exc_info=True)
+
+    def invalidate(self, milestone):
+        """Removes the stored date for a milestone."""
+
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute("""
+                DELETE FROM burndown_start_date
+                WHERE milestone = %s
+                """, [milestone])
+
+
+class RenderCache(object):
+    """Directory of rendered chart images, so each chart is only drawn
+    once for each version of its data.
+
+    Files are named after the milestone, metric and data version. When a
+    new version of a chart is stored, older versions of the same chart are
+    removed."""
+
+    def __init__(self, env, directory):
+        self.env = env
+        self.log = env.log
+        self.directory = directory
+
+    def _prefix(self, milestone, metric):
+        return '%s-%s-' % (md5(milestone.encode('utf-8')).hexdigest(), metric)
+
+    def path(self, milestone, metric, version, extension):
+        """Returns the path of the file for a version of a chart."""
+
+        return os.path.join(self.directory, '%s%s.%s'
+                            % (self._prefix(milestone, metric), version,
+                               extension))
+
+    def get(self, milestone, metric, version, extension):
+        """Returns the contents of the cached file, or None if this version
+        of the chart hasn't been rendered yet."""
+
+        try:
+            with open(self.path(milestone, metric, version, extension),
+                      'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def set(self, milestone, metric, version, extension, content):
+        """Stores the rendered chart, replacing any older versions. Failing
+        to write the file is not fatal, as the caller already holds the
+        content it needs to send."""
+
+        path = self.path(milestone, metric, version, extension)
+        prefix = self._prefix(milestone, metric)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            for name in os.listdir(self.directory):
+                if name.startswith(prefix) and name.endswith('.' + extension):
+                    os.remove(os.path.join(self.directory, name))
+            # write to a temporary file first so that other requests never
+            # read a partly written image
+            temp = '%s.%d.tmp' % (path, os.getpid())
+            with open(temp, 'wb') as f:
+                f.write(content)
+            os.rename(temp, path)
+        except (IOError, OSError):
+            self.log.warning('Unable to cache the burndown chart for %s',
+                             milestone, exc_info=True)
+
+    def invalidate(self, milestone):
+        """Removes all rendered charts for a milestone."""
+
+        prefix = md5(milestone.encode('utf-8')).hexdigest() + '-'
+        try:
+            for name in os.listdir(self.directory):
+                if name.startswith(prefix):
+                    os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+
+class DerivedCache(object):
+    """In memory store of values worked out from the chart data of a 
+    milestone and metric, such as downsampled series and forecasts. The
+    milestone is None for values worked out from many milestones.
+
+    One entry is kept for each milestone and metric, holding the version
+    of the chart data (and anything else the value depends on) it was 
+    made for. Storing a value for another version replaces it."""
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, milestone, metric, version):
+        """Returns the stored value, or None if nothing is stored for this
+        version."""
+
+        entry = self._entries.get((milestone, metric))
+        if entry and entry[0] == version:
+            return entry[1]
+
+    def set(self, milestone, metric, version, value):
+        self._entries[(milestone, metric)] = (version, value)
+
+    def invalidate(self, milestone):
+        """Removes the values stored for a milestone."""
+
+        for key in self._entries.keys():
+            if key[0] == milestone:
+                self._entries.pop(key, None)
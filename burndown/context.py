@@ -0,0 +1,67 @@
+from datetime import timedelta
+
+from trac.util import lazy
+
+
+class BurndownContext(object):
+    """The milestone a burndown chart is drawn for, and everything derived
+    from it that the series builders need.
+
+    One context is created per request, so the milestone is only loaded
+    once and each value below is only calculated the first time it is
+    used. See BurnDownCharts.get_context()."""
+
+    def __init__(self, charts, req, milestone):
+        self.charts = charts
+        self.req = req
+        self.milestone = milestone
+
+    @lazy
+    def milestone_names(self):
+        """The name of the milestone and all of its descendants."""
+
+        return list(self.charts.milestone_subtrees.names(self.milestone.name))
+
+    @lazy
+    def start(self):
+        """The milestone start date, explicit or approximated."""
+
+        return self.charts.get_start_date(self.milestone)
+
+    @lazy
+    def day_before_start(self):
+        """The first date on the x-axis."""
+
+        return self.start - timedelta(days=1)
+
+    @lazy
+    def end(self):
+        """The last date we have data for."""
+
+        return self.charts.get_end_date(self.milestone)
+
+    @lazy
+    def due(self):
+        """The last date on the x-axis."""
+
+        if self.milestone.due:
+            return self.milestone.due.date()
+        return self.end
+
+    @lazy
+    def calendar(self):
+        """The WorkingCalendar used for the ideal curve."""
+
+        return self.charts.calendar_for(self.milestone.name)
+
+    @lazy
+    def dates(self):
+        """Every date from the day before the start to the end date."""
+
+        return self.charts.dates_inbetween(self.day_before_start, self.end)
+
+    @lazy
+    def date_strings(self):
+        """The dates property formatted as yyyy-mm-dd strings."""
+
+        return self.charts.dates_as_strings(self.dates)
@@ -0,0 +1,60 @@
+from trac.db import Table, Column, Index
+
+# Database schema owned by the burndown plugin. The version is stored in
+# the system table under the name below, and bumped whenever the schema
+# changes so upgrade_environment() knows there is work to do.
+
+name = 'burndown_version'
+version = 3
+
+schema = [
+    # Materialized per-day values for each milestone tree and metric. A row
+    # is only written once the history capture has run for that day, so
+    # cached days never need to be recomputed.
+    Table('burndown_series', key=('milestone', 'metric', 'day'))[
+        Column('milestone'),
+        Column('metric'),
+        Column('day'),
+        Column('remaining', type='real'),
+        Column('team_effort', type='real'),
+    ],
+    # One row per (milestone, metric) series, recording what the cached
+    # rows were calculated from so a changed subtree or start date
+    # discards them.
+    Table('burndown_series_state', key=('milestone', 'metric'))[
+        Column('milestone'),
+        Column('metric'),
+        Column('fingerprint'),
+        Column('last_day'),
+    ],
+    # The first day a ticket was assigned to each milestone according to
+    # ticket_bi_historical, used as an approximate start date when the
+    # milestone has none.
+    Table('burndown_start_date', key='milestone')[
+        Column('milestone'),
+        Column('first_seen'),
+    ],
+]
+
+# Indexes the chart queries need on tables owned by Trac and other plugins.
+# Only the indexed columns are listed. ticket_bi_historical and ticket_time
+# may not exist yet when the schema is upgraded, so a missing index is
+# created whenever its table exists, see upgrades/indexes.py.
+indexes = [
+    Table('ticket_bi_historical')[
+        Column('milestone'),
+        Column('_snapshottime', type='date'),
+        Index(['milestone', '_snapshottime']),
+        # for the date of the last history capture, see last_snapshot_day()
+        Index(['_snapshottime']),
+    ],
+    Table('ticket_change')[
+        Column('field'),
+        Column('time', type='int64'),
+        Index(['field', 'time']),
+    ],
+    Table('ticket_time')[
+        Column('time_started', type='int'),
+        Index(['time_started']),
+    ],
+]
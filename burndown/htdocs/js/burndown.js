@@ -1,36 +1,46 @@
 $(document).ready(function(){
 
   var current_metric = "",
+       burndown_data = null,
+           flow_data = null,
+   approx_start_date = null,
            chartName = "milestone-burndown",
               $chart = $("#"+chartName);
 
-  if(!window.render_burndown) {
-    // No start date and can't estimate start so don't try and render the burndown chart
-    $chart.attr("class", "no-data milestone-info")
-                .html("<i class='fa fa-info-circle'></i> As of yesterday " +
-                      "no tickets were associated with this milestone. " + 
-                      "No burn down chart will be generated until it has " +
-                      "ticket data to display.");
-  }
-  else if(window.print_burndown) {
-    // Render print friendly burn down on seperate page
-    open_print_burndown();
-  }
   // Render burndown on milestone page with default metric via AJAX
-  else {
+  if(window.render_burndown) {
     get_and_draw_burndown();
     
-    // Redraw the burndown on milestone page with new metric via AJAX
+    // Redraw the burndown on milestone page with new metric, using the
+    // data for all metrics we already received
     $('#tickets-metric, #hours-metric, #points-metric').click(function() {
-      get_and_draw_burndown($(this).attr("id").split("-")[0]);
+      draw_metric($(this).attr("id").split("-")[0]);
+    });
+
+    // Show the cumulative flow of the milestone in the current metric
+    $('#cumulative-flow').click(function() {
+      get_and_draw_flow();
     });
   }
 
+  // No start date and can't estimate start so don't try and render the burndown chart
+  function no_start_date($chart) {
+    $chart.attr("class", "no-data milestone-info")
+                .html("<i class='fa fa-info-circle'></i> As of yesterday " +
+                      "no tickets were associated with this milestone. " + 
+                      "No burn down chart will be generated until it has " +
+                      "ticket data to display.");
+  }
+
   // to encourage the use of start and end dates we put the opacity at 0.6
-  // and show a message to users which is hidden upon mouseover
-  if (window.approx_start_date) {
+  // and show a message to users which is hidden upon mouseover. The 
+  // server tells us when it had to estimate the start date
+  function warn_approx_start_date(data) {
+    if (data['approx_start_date'] && !approx_start_date) {
       $.jqplot.postDrawHooks.push(start_message_warning)
       $chart.mouseover(remove_opacity);
+    }
+    approx_start_date = data['approx_start_date'] || null;
   }
 
   function start_message_warning(approx_start_date) {
@@ -46,30 +56,22 @@ $(document).ready(function(){
     $("#no-start-date").addClass("hidden");
   }
 
-  function burndown_options(data, print) {
+  function burndown_options(data) {
 
     // Calculate the interval between x-axis dates (aka tickInterval)
     // 20 ticks is about right on a average sized screen
     // We plus one so that for 0.x numbers, we still get a 1 day interval
-    tick_gap = Math.ceil(data['idealcurvedata'].length / 20);
+    // Long milestones may have been downsampled, so count the days on the
+    // axis rather than the points in a series
+    days = (addTime(data['due_date']) - addTime(data['start_date'])) / 86400000 + 1;
+    tick_gap = Math.ceil(days / 20);
     xaxis_interval = tick_gap + " day" + (tick_gap == 1 ? "": "s");
 
-    // Options specific to milestone or print friendly pages
-    if(print) {
-      animateval = replotval = false;
-      xaxislabel = "";
-      legendlocation = "s";
-      legendbackground = "#FFF";
-      titletext = data['milestone_name'];
-    }
-
-    else {
-      animateval = replotval = true;
-      xaxislabel = 'Days in Milestone';
-      legendlocation = 'n';
-      legendbackground = '#DFEEFD';
-      titletext = '';
-    }
+    animateval = replotval = true;
+    xaxislabel = 'Days in Milestone';
+    legendlocation = 'n';
+    legendbackground = '#DFEEFD';
+    titletext = '';
 
     // Chart options
     return {
@@ -127,6 +129,21 @@ $(document).ready(function(){
                 color: '#23932C',
                 showMarker: false,
                 shadow: false
+              },
+              {
+                label:'Work added',
+                color: '#F90',
+                showMarker: false,
+                lineWidth: 1.5,
+                shadow: false
+              },
+              {
+                label: forecast_label(data),
+                color: '#C00',
+                showMarker: false,
+                linePattern: 'dotted',
+                lineWidth: 1.5,
+                shadow: false
               }
              ],
       legend: {
@@ -143,20 +160,60 @@ $(document).ready(function(){
     };
   }
 
-  // Ajax calls to get burndown data and render chart
-  function get_and_draw_burndown(metric) {
-    current_metric = metric;
+  // The legend label of the forecast, with the projected completion date
+  // and the range of dates completed milestones suggest, if we have them
+  function forecast_label(data) {
+    var label = 'Forecast';
+    if (data['forecast_date']) {
+      label += ' (' + data['forecast_date'];
+      if (data['forecast_range']) {
+        label += ', ' + data['forecast_range'][0] + ' to ' + data['forecast_range'][1];
+      }
+      label += ')';
+    }
+    return label;
+  }
+
+  // Ajax call to get burndown data for every metric and render the chart
+  // using the default metric. If we have the data from an earlier visit,
+  // we only ask for the days after the last history snapshot it included
+  function get_and_draw_burndown() {
+    var stored = load_stored_burndown();
     options = {
       type: 'GET',
-      data: {},
+      // a chart can't show more points than this, so the server
+      // downsamples the series of longer milestones
+      data: {metric: 'all', compact: 1, max_points: 400},
       url: window.tracBaseUrl + "burndownchart/" + milestone_name,
+      // the server answers with 304 Not Modified until the chart data 
+      // changes, so let the browser reuse its cached copy
+      cache: true,
       success: function (data) {
         remove_spinner($chart);
         if (!data['result']) {
-          burndown_fail($chart);
+          store_burndown(null);
+          if (data['no_start_date']) {
+            no_start_date($chart);
+          }
+          else {
+            burndown_fail($chart);
+          }
         }
         else {
-          draw_burndown(data, burndown_options(data), !metric);
+          expand_burndown(data);
+          if (data['delta']) {
+            data = merge_burndown(stored, data);
+          }
+          store_burndown(data);
+          warn_approx_start_date(data);
+          burndown_data = data;
+          var metric_data = data_for_metric(data['effort_units']);
+          if (!metric_data['result']) {
+            burndown_fail($chart);
+          }
+          else {
+            draw_burndown(metric_data, burndown_options(metric_data), true);
+          }
         }
       },
       error: function(data, textStatus, jqXHR) {
@@ -166,16 +223,178 @@ $(document).ready(function(){
     };
 
     show_spinner($chart, "145px");
-    if(metric) {
-      $("#burndown-spinner").css("margin-top", "100px");
-      options["data"]["metric"] = metric;
-    }
-    if (approx_start_date) {
-      options["data"]["approx_start_date"] = approx_start_date;
+    if (stored && stored['last_day']) {
+      options["data"]["since"] = stored['last_day'];
+      options["data"]["version"] = stored['version'];
     }
     $.ajax(options);
   }
 
+  // The key the data for this milestone is kept under in localStorage. If
+  // the start date changes, so does the version of the data
+  function storage_key() {
+    return "burndown:" + milestone_name;
+  }
+
+  // Returns the data stored by an earlier visit, or null. localStorage
+  // may be unavailable (eg private browsing), so errors are ignored
+  function load_stored_burndown() {
+    try {
+      return JSON.parse(window.localStorage.getItem(storage_key()));
+    }
+    catch (e) {
+      return null;
+    }
+  }
+
+  function store_burndown(data) {
+    try {
+      if (data) {
+        window.localStorage.setItem(storage_key(), JSON.stringify(data));
+      }
+      else {
+        window.localStorage.removeItem(storage_key());
+      }
+    }
+    catch (e) {
+      // the storage is full or unavailable, so we just won't have the 
+      // data next time
+    }
+  }
+
+  // The server sends each series as a start date and a list of daily 
+  // values, with null for the days without a value. This turns them back
+  // into the [date, value] pairs jqPlot and the stored data use
+  function expand_burndown(data) {
+    if (!data['compact']) {
+      return;
+    }
+    $.each(data['metrics'], function(metric, metric_data) {
+      $.each(['burndowndata', 'teameffortdata', 'workaddeddata', 'idealcurvedata'], function(i, key) {
+        if (metric_data[key]) {
+          metric_data[key] = expand_series(metric_data[key]);
+        }
+      });
+    });
+    delete data['compact'];
+  }
+
+  // yyyy-mm-dd of a UTC date. IE8 has no Date.toISOString()
+  function utc_date_string(date) {
+    var month = date.getUTCMonth() + 1,
+        day = date.getUTCDate();
+    return date.getUTCFullYear() + "-" + (month < 10 ? "0" : "") + month +
+           "-" + (day < 10 ? "0" : "") + day;
+  }
+
+  function expand_series(series) {
+    var points = [];
+    if (!series['start']) {
+      return points;
+    }
+    // dates are counted in UTC so daylight saving changes don't matter
+    var parts = series['start'].split("-"),
+        day = Date.UTC(parts[0], parts[1] - 1, parts[2]);
+    for (var i=0; i < series['values'].length; i++) {
+      if (series['values'][i] !== null) {
+        points.push([utc_date_string(new Date(day)), series['values'][i]]);
+      }
+      day += 86400000;
+    }
+    return points;
+  }
+
+  // Adds the days in a delta response to the stored data. The delta 
+  // holds everything apart from the remaining, team effort and work added
+  // series in full, and those series only for the days after the stored
+  // last_day
+  function merge_burndown(stored, delta) {
+    var since = stored['last_day'];
+    $.each(delta['metrics'], function(metric, metric_data) {
+      var stored_metric = stored['metrics'][metric] || {};
+      $.each(['burndowndata', 'teameffortdata', 'workaddeddata'], function(i, key) {
+        var points = $.grep(stored_metric[key] || [], function(point) {
+          return point[0] <= since;
+        });
+        metric_data[key] = points.concat(metric_data[key] || []);
+      });
+      metric_data['result'] = metric_data['burndowndata'].length > 0;
+    });
+    return delta;
+  }
+
+  // Returns the chart data for one metric, combining the series for that
+  // metric with the values shared by all metrics
+  function data_for_metric(metric) {
+    return $.extend({}, burndown_data, burndown_data['metrics'][metric]);
+  }
+
+  // Redraw the burndown with a different metric. No request is needed as 
+  // we received the data for all metrics with the first response
+  function draw_metric(metric) {
+    if (!burndown_data) {
+      return;
+    }
+    current_metric = metric;
+    var metric_data = data_for_metric(metric);
+    if (!metric_data['result']) {
+      burndown_fail($chart);
+    }
+    else {
+      $chart.removeClass("no-data");
+      draw_burndown(metric_data, burndown_options(metric_data), false);
+    }
+  }
+
+  // Ajax call to get the cumulative flow data for every metric, which is
+  // only sent for the first time the flow chart is shown
+  function get_and_draw_flow() {
+    if (flow_data) {
+      draw_flow();
+      return;
+    }
+    $chart.html("");
+    show_spinner($chart, "145px");
+    $.ajax({
+      type: 'GET',
+      data: {metric: 'all', chart: 'flow'},
+      url: window.tracBaseUrl + "burndownchart/" + milestone_name,
+      cache: true,
+      success: function (data) {
+        remove_spinner($chart);
+        if (!data['result']) {
+          burndown_fail($chart);
+        }
+        else {
+          flow_data = data;
+          draw_flow();
+        }
+      },
+      error: function(data, textStatus, jqXHR) {
+        remove_spinner($chart);
+        burndown_fail($chart);
+      }
+    });
+  }
+
+  // Draws the cumulative flow chart for the current metric, with one 
+  // stacked area for each status
+  function draw_flow() {
+    var metric = current_metric || flow_data['effort_units'],
+        data = $.extend({}, flow_data, flow_data['metrics'][metric]),
+        options = burndown_options(data),
+        curves = [];
+    options['stackSeries'] = true;
+    options['seriesDefaults'] = {fill: true, showMarker: false, shadow: false};
+    options['series'] = [];
+    $.each(data['statuses'], function(i, status) {
+      curves.push(dataSeries(data['flowdata'][status]));
+      options['series'].push({label: status});
+    });
+    $chart.removeClass("no-data").html("");
+    window.plot1 = $.jqplot(chartName, curves, options);
+  }
+
   // Expects date as a string in yyyy-mm-dd format, with a time added for 
   // greater accuracy. We use jQuery datepicker to create the date time object
   // as IE8 can't cope with yyyy-mm-dd
@@ -210,10 +429,12 @@ $(document).ready(function(){
     burndowncurve = dataSeries(data['burndowndata']);
     teameffortcurve = dataSeries(data['teameffortdata']);
     idealcurve = dataSeries(data['idealcurvedata']);
+    workaddedcurve = dataSeries(data['workaddeddata'] || []);
+    forecastcurve = dataSeries(data['forecastdata'] || []);
 
     // Render the jqPlot burn down chart
     window.plot1 = $.jqplot(chartName,
-                            [idealcurve, burndowncurve, teameffortcurve],
+                            [idealcurve, burndowncurve, teameffortcurve, workaddedcurve, forecastcurve],
                             options);
 
     // Makes the data points clickable, redirecting the user to the timeline
@@ -258,26 +479,15 @@ $(document).ready(function(){
     burndowncurve = dataSeries(data['burndowndata']);
     teameffortcurve = dataSeries(data['teameffortdata']);
     idealcurve = dataSeries(data['idealcurvedata']);
+    workaddedcurve = dataSeries(data['workaddeddata'] || []);
+    forecastcurve = dataSeries(data['forecastdata'] || []);
 
     $chart.html("");
     window.plot1 = $.jqplot(chartName,
-                            [idealcurve, burndowncurve, teameffortcurve],
+                            [idealcurve, burndowncurve, teameffortcurve, workaddedcurve, forecastcurve],
                             options);
   }
 
-  function open_print_burndown() {
-    $chart.css({"height": "800px", "width":"1450px", "margin-bottom": "40px"});
-    draw_burndown(window.data, burndown_options(window.data, true), true);
-
-    // Style chart to be print friendly
-    $(".jqplot-table-legend").css({"top": "810px", "border": 0});
-    $(".jqplot-cursor-legend").css("border", 0);
-
-    // Create an image overwriting the original canvas
-    $chart.html("<img src='" + $chart.jqplotToImageStr({}) + "' />");
-    window.print();
-  }
-
   function burndown_fail($chart) {
     $chart.attr("class", "no-data milestone-info")
           .html("<i class='fa fa-info-circle'></i> Failed to retrieve burn down data.");
@@ -297,8 +507,7 @@ $(document).ready(function(){
   // Open a new window with a burndown chart (print friendly)
   $('#print-burndown').click(function() {
     metric_get = current_metric ? "&metric=" + current_metric : "";
-    approx_date = approx_start_date ? "&approx_start_date=" + approx_start_date : "";
-    window.open(window.tracBaseUrl + 'burndownchart/' + milestone_name +'?format=print&id=' + milestone_name + metric_get + approx_date);
+    window.open(window.tracBaseUrl + 'burndownchart/' + milestone_name +'?format=print&id=' + milestone_name + metric_get);
   });
 
 });
\ No newline at end of file
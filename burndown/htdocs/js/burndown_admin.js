@@ -25,6 +25,32 @@ $(document).ready(function(){
       });
     });
 
+    $('#holidays-question').click(function() {
+      $('#holidays-dialog').dialog({
+        title: 'More Information - Holidays',
+        width: 400,
+        modal: true,
+        buttons: {
+          'Close': function() {
+            $(this).dialog('close');
+          }
+        }
+      });
+    });
+
+    $('#team-calendar-question').click(function() {
+      $('#team-calendar-dialog').dialog({
+        title: 'More Information - Team Calendars',
+        width: 400,
+        modal: true,
+        buttons: {
+          'Close': function() {
+            $(this).dialog('close');
+          }
+        }
+      });
+    });
+
     $('#ideal-curve-question').click(function() {
       $('#ideal-curve-dialog').dialog({
         title: 'More Information - Idea Curve',
@@ -0,0 +1,40 @@
+// Fetches the burndown chart script once the chart container scrolls into
+// view. Browsers which can't tell us that fetch it straight away
+(function($) {
+  var loaded = false;
+
+  function load() {
+    if (!loaded) {
+      loaded = true;
+      $.ajax({
+        url: window.burndown_bundle_url,
+        dataType: 'script',
+        // the URL changes with the content, so the browser can keep it
+        cache: true
+      });
+    }
+  }
+
+  $(document).ready(function() {
+    var chart = document.getElementById('milestone-burndown');
+    if (!chart) {
+      return;
+    }
+    if (!window.IntersectionObserver) {
+      load();
+      return;
+    }
+    var observer = new IntersectionObserver(function(entries) {
+      if (entries[0].isIntersecting) {
+        observer.disconnect();
+        load();
+      }
+    });
+    observer.observe(chart);
+
+    // the links in the context navigation need the script too
+    $('#print-burndown, #tickets-metric, #hours-metric, #points-metric, ' +
+      '#cumulative-flow')
+      .one('mouseenter', load);
+  });
+})(jQuery);
@@ -0,0 +1,178 @@
+"""Server side rendering of burndown charts as SVG, and optionally PNG.
+
+The charts drawn here look like the jqPlot charts on the milestone page,
+but are plain images, so print pages and wiki pages can show a chart
+without loading any JavaScript. The SVG is written by hand as a string, so
+no extra packages are needed. PNG output needs the optional cairosvg
+package.
+"""
+
+from datetime import datetime, timedelta
+from math import ceil, floor, log10
+from xml.sax.saxutils import escape
+
+try:
+    import cairosvg
+except ImportError:
+    cairosvg = None
+
+WIDTH = 1450
+HEIGHT = 800
+
+# space around the plot area for the title, axis labels and legend
+MARGIN_TOP = 60
+MARGIN_RIGHT = 40
+MARGIN_BOTTOM = 110
+MARGIN_LEFT = 90
+
+# label, colour, dash pattern and width of each series, as in burndown.js
+SERIES = (
+    ('idealcurvedata', 'Ideal effort', '#AAA', '6,4', 1.25),
+    ('burndowndata', 'Remaining effort', '#06C', None, 2.5),
+    ('teameffortdata', 'Team effort', '#23932C', None, 2.5),
+    ('workaddeddata', 'Work added', '#F90', None, 1.5),
+    ('forecastdata', 'Forecast', '#C00', '2,4', 1.5),
+)
+
+FONT = 'font-family="Arial, Helvetica, sans-serif"'
+
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def _nice_step(maximum, ticks=8):
+    """Returns a step of 1, 2 or 5 times a power of ten which splits the
+    range from 0 to maximum into at most about ticks intervals."""
+
+    if maximum <= 0:
+        return 1
+    raw = float(maximum) / ticks
+    magnitude = 10 ** floor(log10(raw))
+    for multiple in (1, 2, 5, 10):
+        if raw <= multiple * magnitude:
+            return multiple * magnitude
+
+
+def _number(value):
+    if value == int(value):
+        return str(int(value))
+    return ('%.2f' % value).rstrip('0')
+
+
+def _svg(width, height, body):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<svg xmlns="http://www.w3.org/2000/svg" version="1.1" '
+            'width="%d" height="%d" viewBox="0 0 %d %d">\n'
+            '<rect width="100%%" height="100%%" fill="#FFF"/>\n'
+            '%s\n</svg>\n' % (width, height, width, height,
+                              '\n'.join(body)))
+
+
+def render_message(message, width=WIDTH, height=HEIGHT):
+    """Returns an SVG document showing just the message, used when there
+    is no data to draw a chart with."""
+
+    return _svg(width, height, [
+        '<text x="%d" y="%d" text-anchor="middle" font-size="20" '
+        'fill="#666" %s>%s</text>' % (width / 2, height / 2, FONT,
+                                      escape(message))])
+
+
+def render_svg(data, width=WIDTH, height=HEIGHT):
+    """Returns an SVG document drawing the ideal, remaining effort, team
+    effort and work added curves of the chart data for a single metric, 
+    as returned by BurnDownCharts.chart_data()."""
+
+    start = _parse_date(data['start_date'])
+    end = _parse_date(data['due_date'])
+    maximum = 0
+    for key, label, colour, dash, line_width in SERIES:
+        for day, value in data.get(key, ()):
+            end = max(end, _parse_date(day))
+            maximum = max(maximum, value or 0)
+
+    days = max((end - start).days, 1)
+    step = _nice_step(maximum)
+    top = max(step * ceil(maximum / step), step)
+
+    plot_width = width - MARGIN_LEFT - MARGIN_RIGHT
+    plot_height = height - MARGIN_TOP - MARGIN_BOTTOM
+    bottom = MARGIN_TOP + plot_height
+
+    def x(day):
+        return (MARGIN_LEFT +
+                plot_width * (_parse_date(day) - start).days / float(days))
+
+    def y(value):
+        return bottom - plot_height * (value or 0) / float(top)
+
+    body = []
+
+    # title
+    body.append('<text x="%d" y="%d" text-anchor="middle" font-size="22" '
+                '%s>%s</text>' % (width / 2, MARGIN_TOP / 2 + 8, FONT,
+                                  escape(data['milestone_name'])))
+
+    # horizontal grid lines and y axis labels
+    for i in xrange(int(round(top / step)) + 1):
+        tick = i * step
+        body.append('<line x1="%d" y1="%.1f" x2="%d" y2="%.1f" '
+                    'stroke="#EEE"/>' % (MARGIN_LEFT, y(tick),
+                                         MARGIN_LEFT + plot_width, y(tick)))
+        body.append('<text x="%d" y="%.1f" text-anchor="end" font-size="13" '
+                    '%s>%s</text>' % (MARGIN_LEFT - 8, y(tick) + 4, FONT,
+                                      _number(tick)))
+
+    # x axis labels, at most about 20 as on the milestone page
+    interval = int(ceil((days + 1) / 20.0))
+    for i in xrange(0, days + 1, interval):
+        day = start + timedelta(days=i)
+        left = MARGIN_LEFT + plot_width * i / float(days)
+        body.append('<line x1="%.1f" y1="%d" x2="%.1f" y2="%d" '
+                    'stroke="#AAA"/>' % (left, bottom, left, bottom + 5))
+        body.append('<text x="%.1f" y="%d" text-anchor="middle" '
+                    'font-size="13" %s>%s</text>'
+                    % (left, bottom + 22, FONT, day.strftime('%d %b')))
+
+    # y axis title
+    body.append('<text x="%d" y="%d" text-anchor="middle" font-size="15" '
+                'transform="rotate(-90 %d %d)" %s>%s</text>'
+                % (25, MARGIN_TOP + plot_height / 2, 25,
+                   MARGIN_TOP + plot_height / 2, FONT,
+                   escape(data['yaxix_label'])))
+
+    # plot border
+    body.append('<rect x="%d" y="%d" width="%d" height="%d" fill="none" '
+                'stroke="#AAA"/>' % (MARGIN_LEFT, MARGIN_TOP, plot_width,
+                                     plot_height))
+
+    # series, with a legend entry for each below the plot
+    legend_x = width / 2 - 95 * len(SERIES) + 30
+    for key, label, colour, dash, line_width in SERIES:
+        points = ' '.join('%.1f,%.1f' % (x(day), y(value))
+                          for day, value in data.get(key, ()))
+        dash_attr = ' stroke-dasharray="%s"' % dash if dash else ''
+        if points:
+            body.append('<polyline points="%s" fill="none" stroke="%s" '
+                        'stroke-width="%s"%s/>' % (points, colour, line_width,
+                                                   dash_attr))
+        legend_y = height - 35
+        body.append('<line x1="%d" y1="%d" x2="%d" y2="%d" stroke="%s" '
+                    'stroke-width="%s"%s/>' % (legend_x, legend_y,
+                                               legend_x + 30, legend_y,
+                                               colour, line_width, dash_attr))
+        body.append('<text x="%d" y="%d" font-size="14" %s>%s</text>'
+                    % (legend_x + 38, legend_y + 5, FONT, escape(label)))
+        legend_x += 190
+
+    return _svg(width, height, body)
+
+
+def svg_to_png(svg):
+    """Returns the SVG document converted to PNG, or None if the optional
+    cairosvg package is not installed."""
+
+    if cairosvg is None:
+        return None
+    return cairosvg.svg2png(bytestring=svg.encode('utf-8'))
@@ -0,0 +1,234 @@
+"""Operations on burndown series stored as dense, day indexed lists.
+
+Each series is a list holding one value per day, where index 0 is the
+first day on the chart's x-axis (the day before the milestone starts) and
+missing days hold None. Working on whole lists keeps every operation
+linear in the length of the milestone. Series are only converted to the
+(date string, value) tuples the JavaScript expects at the very end, by
+pairs(), and compact() packs those tuples back into a start date and a
+list for the compact JSON payload.
+"""
+
+from datetime import datetime, timedelta
+
+
+def day_strings(start, end):
+    """Returns a yyyy-mm-dd string for each day from start to end
+    inclusive."""
+
+    return [(start + timedelta(days=i)).strftime('%Y-%m-%d')
+            for i in xrange((end - start).days + 1)]
+
+
+def dense(dates, pairs, default=None):
+    """Returns a list with one value for each date string in dates, taken
+    from the (date string, value) pairs. Dates without a pair get the
+    default value and pairs outside the dates are ignored."""
+
+    index = dict((day, i) for i, day in enumerate(dates))
+    values = [default] * len(dates)
+    for day, value in pairs:
+        i = index.get(day)
+        if i is not None:
+            values[i] = value
+    return values
+
+
+def pairs(dates, values, skip_missing=False):
+    """Returns a list of (date string, value) tuples for JSON. If
+    skip_missing is True, days holding None are left out."""
+
+    if skip_missing:
+        return [(day, value) for day, value in zip(dates, values)
+                if value is not None]
+    return zip(dates, values)
+
+
+def fill(values, value=0):
+    """Returns a copy of values with missing days replaced by value."""
+
+    return [value if v is None else v for v in values]
+
+
+def carry_forward(values):
+    """Returns a copy of values with each missing day replaced by the
+    value of the last day before it which has one. Days before the first
+    value stay missing."""
+
+    filled = []
+    last = None
+    for v in values:
+        if v is not None:
+            last = v
+        filled.append(last)
+    return filled
+
+
+def ideal(estimate, working):
+    """Returns the ideal remaining effort for each day, given a mask of
+    working days. The effort decreases by an equal amount on each working
+    day and stays level on non working days, reaching zero on the last
+    working day. The first day should always be a working day."""
+
+    try:
+        work_per_day = float(estimate) / (sum(working) - 1)
+    except ZeroDivisionError:
+        # the milestone is only 1 day long
+        work_per_day = estimate
+
+    values = []
+    # number of working days strictly before the current day
+    work_days = 0
+    for is_working in working:
+        if is_working:
+            values.append(estimate - work_per_day * work_days)
+            work_days += 1
+        else:
+            # the same as the last working day, or the estimate if there
+            # hasn't been one yet
+            values.append(estimate - work_per_day * max(work_days - 1, 0))
+    return values
+
+
+def variable_ideal(estimate, working, added):
+    """Returns the ideal remaining effort for each day when work added
+    after the start is included. The estimate is the effort on the first
+    day, and added holds the work added on each day. Each day's work is
+    added to the ideal effort, which is then shared equally between the
+    working days left, so with nothing added this matches ideal()."""
+
+    if not working:
+        return []
+
+    level = estimate
+    values = [level]
+    # number of working days from the current day to the last day
+    working_left = sum(working[1:])
+    for is_working, work in zip(working[1:], added[1:]):
+        level += work or 0
+        if is_working:
+            level -= float(level) / working_left
+            working_left -= 1
+        values.append(level)
+    return values
+
+
+def work_added(remaining, logged):
+    """Returns the work added on each day, which is the difference between
+    the remaining effort on that day and the day before plus the work
+    logged on that day. Work can be added by creating a new ticket in the
+    milestone, moving a ticket into it or increasing the remaining effort.
+
+    A day without remaining effort is taken to have the same remaining
+    effort as the day before, so a gap in the history isn't counted as
+    work added. Days before the first remaining effort are missing.
+
+    If the result is negative, we use zero instead.
+    see https://d4.define.logica.com/ticket/3727"""
+
+    added = []
+    previous = None
+    for value, work in zip(carry_forward(remaining), fill(logged)):
+        if value is None:
+            added.append(None)
+            continue
+        change = 0 if previous is None else value - previous
+        added.append(max(0, change + work))
+        previous = value
+    return added
+
+
+def merge_sum(mappings):
+    """Returns a dictionary mapping each date string found in any of the
+    mappings to the sum of its values. Missing values (None) are only kept
+    if no mapping has a value for that date."""
+
+    merged = {}
+    for mapping in mappings:
+        for day, value in mapping.iteritems():
+            current = merged.get(day)
+            if current is None:
+                merged[day] = value
+            elif value is not None:
+                merged[day] = current + value
+    return merged
+
+
+def compact(pairs):
+    """Returns the (date string, value) pairs of a series as a dictionary
+    holding the first date and a list with one value for each day from
+    then to the last date, where days without a pair hold None. The pairs
+    must be in date order."""
+
+    if not pairs:
+        return {'start': None, 'values': []}
+
+    first = datetime.strptime(pairs[0][0], '%Y-%m-%d').date()
+    last = datetime.strptime(pairs[-1][0], '%Y-%m-%d').date()
+    return {'start': pairs[0][0],
+            'values': dense(day_strings(first, last), pairs)}
+
+
+def downsample(pairs, max_points):
+    """Returns at most max_points of the (date string, value) pairs, 
+    chosen with the Largest-Triangle-Three-Buckets algorithm so the shape
+    of the curve is kept. The first and last pairs are always kept, and
+    pairs without a value are left out. The pairs must be in date order."""
+
+    points = [(day, value) for day, value in pairs if value is not None]
+    if max_points < 3 or len(points) <= max_points:
+        return points
+
+    xs = [datetime.strptime(day, '%Y-%m-%d').toordinal()
+          for day, value in points]
+    ys = [value for day, value in points]
+
+    # the points between the first and last are split into buckets, and
+    # the point of each bucket forming the largest triangle with the point
+    # chosen from the previous bucket and the average of the next bucket
+    # is kept
+    size = float(len(points) - 2) / (max_points - 2)
+    sampled = [points[0]]
+    previous = 0
+    for bucket in xrange(max_points - 2):
+        start = int(bucket * size) + 1
+        end = int((bucket + 1) * size) + 1
+        next_end = min(int((bucket + 2) * size) + 1, len(points))
+        count = next_end - end
+        average_x = float(sum(xs[end:next_end])) / count
+        average_y = float(sum(ys[end:next_end])) / count
+
+        chosen, largest = start, -1
+        for i in xrange(start, end):
+            area = abs((xs[previous] - average_x) * (ys[i] - ys[previous]) -
+                       (xs[previous] - xs[i]) * (average_y - ys[previous]))
+            if area > largest:
+                chosen, largest = i, area
+        sampled.append(points[chosen])
+        previous = chosen
+
+    sampled.append(points[-1])
+    return sampled
+
+
+def linear_fit(xs, ys):
+    """Returns the (slope, intercept) of the least squares line through
+    the points, or None if there are fewer than two distinct xs."""
+
+    count = len(xs)
+    if count < 2:
+        return None
+    mean_x = float(sum(xs)) / count
+    mean_y = float(sum(ys)) / count
+    sxx = sum((x - mean_x) ** 2 for x in xs)
+    if not sxx:
+        return None
+    sxy = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    slope = sxy / sxx
+    return slope, mean_y - slope * mean_x
+
+
+def percentile(values, p):
+    """Returns the value at the p-th percentile of the sorted values."""
+
+    return values[min(len(values) - 1, len(values) * p // 100)]
@@ -0,0 +1,16 @@
+import unittest
+
+from burndown.tests import chart_requests, closed_tickets, metric, series
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(chart_requests.suite())
+    suite.addTest(closed_tickets.suite())
+    suite.addTest(metric.suite())
+    suite.addTest(series.suite())
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
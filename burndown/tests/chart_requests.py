@@ -0,0 +1,54 @@
+import unittest
+
+from trac.perm import PermissionError
+from trac.test import EnvironmentStub, Mock, MockPerm
+from trac.web.api import RequestDone
+
+from burndown.burndown import BurnDownCharts
+
+
+class SingleChartRequestTestCase(unittest.TestCase):
+    """Tests for process_request() with a single milestone."""
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'burndown.*'])
+        self.charts = BurnDownCharts(self.env)
+        self.headers = {}
+        self.content = []
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _request(self, perm=None, start=None, **args):
+        args.setdefault('id', 'milestone1')
+        context = Mock(milestone=Mock(name='milestone1', resource=None),
+                       milestone_names=['milestone1'], start=start)
+        return Mock(args=args, _burndown_context=context, method='GET',
+                    perm=perm or MockPerm(), get_header=lambda name: None,
+                    send_response=lambda code: None,
+                    send_header=self.headers.__setitem__,
+                    end_headers=lambda: None, write=self.content.append)
+
+    def test_image_without_start_date(self):
+        req = self._request(format='svg')
+        self.assertRaises(RequestDone, self.charts.process_request, req)
+        self.assertEqual('image/svg+xml', self.headers['Content-Type'])
+        self.assertTrue(self.content[0].startswith('<?xml'))
+
+    def test_milestone_view_is_required(self):
+        def require(action):
+            raise PermissionError(action)
+        perm = Mock(require=require)
+        req = self._request(perm=lambda resource: perm, format='svg')
+        self.assertRaises(PermissionError, self.charts.process_request, req)
+        self.assertEqual([], self.content)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SingleChartRequestTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,85 @@
+import unittest
+
+from trac.test import EnvironmentStub
+
+from burndown.burndown import BurnDownCharts
+from burndown.cache import ClosedStatuses
+
+
+class CountTicketsClosedTestCase(unittest.TestCase):
+    """Tests for BurnDownCharts.count_tickets_closed(), which is passed
+    rows of (ticket, date, type, old status, new status, effort) ordered 
+    by date and then by the time of the change."""
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'burndown.*'])
+        self.charts = BurnDownCharts(self.env)
+        self.closed_statuses = ClosedStatuses({
+            'task': ['closed', 'resolved'],
+            'defect': ['closed'],
+        })
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _count(self, changes, metric='tickets'):
+        return self.charts.count_tickets_closed(changes,
+                                                self.closed_statuses, metric)
+
+    def test_close_reopen_and_close_on_one_day(self):
+        changes = [
+            (1, '2015-03-02', 'task', 'new', 'closed', None),
+            (1, '2015-03-02', 'task', 'closed', 'reopened', None),
+            (1, '2015-03-02', 'task', 'reopened', 'closed', None),
+        ]
+        self.assertEqual([('2015-03-02', 1)], self._count(changes))
+
+    def test_close_and_reopen_on_one_day(self):
+        changes = [
+            (1, '2015-03-02', 'task', 'new', 'resolved', None),
+            (1, '2015-03-02', 'task', 'resolved', 'reopened', None),
+            (2, '2015-03-02', 'defect', 'new', 'closed', None),
+        ]
+        self.assertEqual([('2015-03-02', 1)], self._count(changes))
+
+    def test_close_and_reopen_on_the_next_day(self):
+        changes = [
+            (1, '2015-03-02', 'task', 'new', 'closed', None),
+            (1, '2015-03-03', 'task', 'closed', 'reopened', None),
+        ]
+        self.assertEqual([('2015-03-02', 1), ('2015-03-03', 0)],
+                         self._count(changes))
+
+    def test_points_are_weighted_by_effort(self):
+        changes = [
+            (1, '2015-03-02', 'task', 'new', 'closed', 3),
+            (2, '2015-03-02', 'defect', 'new', 'closed', 5),
+            (3, '2015-03-02', 'task', 'new', 'closed', None),
+            (1, '2015-03-03', 'task', 'closed', 'reopened', 3),
+            (4, '2015-03-03', 'task', 'new', 'resolved', 2.5),
+        ]
+        self.assertEqual([('2015-03-02', 8), ('2015-03-03', 2.5)],
+                         self._count(changes, 'points'))
+
+    def test_tickets_count_one_whatever_the_effort(self):
+        changes = [
+            (1, '2015-03-02', 'task', 'new', 'closed', 3),
+            (2, '2015-03-02', 'task', 'new', 'closed', None),
+        ]
+        self.assertEqual([('2015-03-02', 2)], self._count(changes))
+
+    def test_unknown_type_is_never_closed(self):
+        changes = [
+            (1, '2015-03-02', 'story', 'new', 'closed', 8),
+            (2, '2015-03-02', 'defect', 'new', 'resolved', 1),
+        ]
+        self.assertEqual([('2015-03-02', 0)], self._count(changes))
+        self.assertEqual([('2015-03-02', 0)], self._count(changes, 'points'))
+
+
+def suite():
+    return unittest.makeSuite(CountTicketsClosedTestCase)
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,63 @@
+import unittest
+from datetime import datetime
+
+from trac.test import EnvironmentStub, Mock, MockPerm
+from trac.util.datefmt import utc
+from trac.web.api import HTTPBadRequest, RequestDone
+
+from burndown.burndown import BurnDownCharts
+
+
+class MetricArgumentTestCase(unittest.TestCase):
+    """Tests that process_request() rejects an unknown metric argument
+    before any chart data is worked out, rendered or cached."""
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'burndown.*'])
+        self.charts = BurnDownCharts(self.env)
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _request(self, **args):
+        args.setdefault('id', 'milestone1')
+        context = Mock(milestone=Mock(name='milestone1', resource=None),
+                       milestone_names=['milestone1'],
+                       start=datetime(2015, 3, 2, tzinfo=utc))
+        return Mock(args=args, _burndown_context=context, perm=MockPerm(),
+                    get_header=lambda name: 'XMLHttpRequest',
+                    redirect=lambda url: self.fail('Redirected'))
+
+    def _fail(self, *args, **kwargs):
+        self.fail('The chart data was requested')
+
+    def test_unknown_metric_for_flow_chart(self):
+        self.charts._send_flow = self._fail
+        req = self._request(chart='flow', metric='unknown')
+        self.assertRaises(HTTPBadRequest, self.charts.process_request, req)
+
+    def test_unknown_metric_for_image(self):
+        self.charts._send_image = self._fail
+        req = self._request(format='svg', metric='../unknown')
+        self.assertRaises(HTTPBadRequest, self.charts.process_request, req)
+
+    def test_all_metrics_for_flow_chart(self):
+        metrics = []
+        def send_flow(req, db, context, metric, version, timer):
+            metrics.append(metric)
+            raise RequestDone
+        self.charts._check_modified = lambda *args: ('version', None)
+        self.charts._send_flow = send_flow
+        req = self._request(chart='flow', metric='all')
+        self.assertRaises(RequestDone, self.charts.process_request, req)
+        self.assertEqual(['all'], metrics)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(MetricArgumentTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
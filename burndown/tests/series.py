@@ -0,0 +1,30 @@
+import unittest
+
+from burndown import series
+
+
+class WorkAddedTestCase(unittest.TestCase):
+    """Tests for series.work_added(), which is passed the remaining effort
+    and the work logged on each day, with None for missing days."""
+
+    def test_work_added_and_logged(self):
+        self.assertEqual([0, 0, 5, 0],
+                         series.work_added([10, 8, 11, 9], [0, 2, 2, 0]))
+
+    def test_gap_carries_remaining_effort_forward(self):
+        self.assertEqual([0, 0, 0, 3],
+                         series.work_added([10, None, None, 13], [0, 0, 0, 0]))
+
+    def test_days_before_first_remaining_effort_are_missing(self):
+        self.assertEqual([None, 0, 2],
+                         series.work_added([None, 10, 12], [1, 0, 0]))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(WorkAddedTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,140 @@
+"""Timing of the phases of a burndown chart request.
+
+When the [burndown] timing option is enabled, each request gets a
+PhaseTimer recording the wall time and row count of each phase, which is
+sent to the browser as a Server-Timing header and written to the log as a
+single line of JSON. The durations are also added to the PhaseStats of
+the environment, which the admin panel shows as percentiles.
+
+When timing is disabled, requests get the shared NULL_TIMER instead, whose
+methods do nothing.
+"""
+
+import json
+import threading
+import time
+from collections import deque
+
+
+class _Phase(object):
+    """A phase being timed. Set rows to record how many rows or values
+    the phase produced."""
+
+    __slots__ = ('timer', 'name', 'started', 'rows')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.rows = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timer.phases.append((self.name, time.time() - self.started,
+                                  self.rows))
+
+
+class PhaseTimer(object):
+    """Records the duration and row count of each phase of one request."""
+
+    enabled = True
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = []
+
+    def phase(self, name):
+        """Returns a context manager timing the named phase."""
+
+        return _Phase(self, name)
+
+    def total(self):
+        return time.time() - self.started
+
+    def header(self):
+        """Returns the value of the Server-Timing header, with durations
+        in milliseconds."""
+
+        entries = []
+        for name, duration, rows in self.phases:
+            entry = '%s;dur=%.1f' % (name, duration * 1000)
+            if rows is not None:
+                entry += ';desc="%d rows"' % rows
+            entries.append(entry)
+        entries.append('total;dur=%.1f' % (self.total() * 1000))
+        return ', '.join(entries)
+
+    def log_line(self, **fields):
+        """Returns a line of JSON with the fields, the total duration and
+        the duration and row count of each phase."""
+
+        fields['total_ms'] = round(self.total() * 1000, 1)
+        fields['phases'] = [dict(name=name, ms=round(duration * 1000, 1),
+                                 rows=rows)
+                            for name, duration, rows in self.phases]
+        return json.dumps(fields, sort_keys=True)
+
+
+class _NullPhase(object):
+    __slots__ = ('rows',)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class NullTimer(object):
+    """Timer used when timing is disabled, which records nothing."""
+
+    enabled = False
+
+    _phase = _NullPhase()
+
+    def phase(self, name):
+        return self._phase
+
+
+NULL_TIMER = NullTimer()
+
+
+class PhaseStats(object):
+    """The durations of the most recent requests for each phase, kept in
+    memory by each process so the admin panel can show percentiles.
+    Durations from different threads may be added at the same time."""
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._lock = threading.Lock()
+        self._durations = {}
+
+    def add(self, timer):
+        """Adds the phase durations of a finished request."""
+
+        durations = [(name, duration)
+                     for name, duration, rows in timer.phases]
+        durations.append(('total', timer.total()))
+        with self._lock:
+            for name, duration in durations:
+                if name not in self._durations:
+                    self._durations[name] = deque(maxlen=self.size)
+                self._durations[name].append(duration)
+
+    def percentiles(self, percentiles=(50, 90, 99)):
+        """Returns a sorted list of (phase name, count, [durations]) tuples,
+        with the duration in milliseconds at each percentile."""
+
+        with self._lock:
+            durations = [(name, sorted(values))
+                         for name, values in self._durations.iteritems()]
+
+        stats = []
+        for name, values in sorted(durations):
+            stats.append((name, len(values),
+                          [values[min(len(values) - 1,
+                                      len(values) * p // 100)] * 1000
+                           for p in percentiles]))
+        return stats
@@ -0,0 +1,12 @@
+from burndown.upgrades.indexes import create_missing_indexes
+
+
+def do_upgrade(env, version, cursor):
+    """Adds the indexes used by the remaining effort and team effort
+    queries, see db_default.indexes.
+
+    ticket_bi_historical and ticket_time belong to other plugins, which
+    may not have created them yet. Their indexes are created by a later
+    upgrade once they exist, see environment_needs_upgrade()."""
+
+    create_missing_indexes(env, cursor)
@@ -0,0 +1,13 @@
+from trac.db import DatabaseManager
+
+from burndown import db_default
+
+
+def do_upgrade(env, version, cursor):
+    """Creates the table used to remember approximate start dates."""
+
+    connector = DatabaseManager(env).get_connector()[0]
+    for table in db_default.schema:
+        if table.name == 'burndown_start_date':
+            for stmt in connector.to_sql(table):
+                cursor.execute(stmt)
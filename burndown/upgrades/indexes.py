@@ -0,0 +1,99 @@
+from trac.db import DatabaseManager, Table
+
+from burndown import db_default
+
+
+def index_name(table, index):
+    """Returns the name Trac's database connectors give the index."""
+
+    return '%s_%s_idx' % (table.name, '_'.join(index.columns))
+
+
+def missing_indexes(env, cursor):
+    """Returns a list of (table, index) tuples for each index in
+    db_default.indexes which doesn't exist yet, on a table which does."""
+
+    missing = []
+    for table in db_default.indexes:
+        if not table_exists(env, cursor, table.name):
+            continue
+        for index in table.indices:
+            if not index_exists(env, cursor, table.name,
+                                index_name(table, index)):
+                missing.append((table, index))
+    return missing
+
+
+def create_missing_indexes(env, cursor):
+    """Creates the indexes returned by missing_indexes(). The statements
+    come from the database connector, which knows how to index text
+    columns on MySQL."""
+
+    connector = DatabaseManager(env).get_connector()[0]
+    for table, index in missing_indexes(env, cursor):
+        single = Table(table.name)[table.columns + [index]]
+        # the first statement creates the table, which already exists
+        for stmt in list(connector.to_sql(single))[1:]:
+            cursor.execute(stmt)
+        env.log.info('Created index %s', index_name(table, index))
+
+
+def table_exists(env, cursor, table):
+    """Returns True if the table exists. Querying a missing table would
+    abort the upgrade transaction on PostgreSQL, so we look in the
+    database catalog instead."""
+
+    uri = DatabaseManager(env).connection_uri
+    if uri.startswith('sqlite'):
+        cursor.execute("""
+            SELECT name
+            FROM sqlite_master
+            WHERE type = 'table'
+                AND name = %s
+            """, [table])
+    elif uri.startswith('postgres'):
+        cursor.execute("""
+            SELECT table_name
+            FROM information_schema.tables
+            WHERE table_schema = current_schema()
+                AND table_name = %s
+            """, [table])
+    else:
+        cursor.execute("""
+            SELECT table_name
+            FROM information_schema.tables
+            WHERE table_schema = DATABASE()
+                AND table_name = %s
+            """, [table])
+    return cursor.fetchone() is not None
+
+
+def index_exists(env, cursor, table, index):
+    """Returns True if the table has an index with that name."""
+
+    uri = DatabaseManager(env).connection_uri
+    if uri.startswith('sqlite'):
+        cursor.execute("""
+            SELECT name
+            FROM sqlite_master
+            WHERE type = 'index'
+                AND tbl_name = %s
+                AND name = %s
+            """, [table, index])
+    elif uri.startswith('postgres'):
+        cursor.execute("""
+            SELECT indexname
+            FROM pg_indexes
+            WHERE schemaname = current_schema()
+                AND tablename = %s
+                AND indexname = %s
+            """, [table, index])
+    else:
+        cursor.execute("""
+            SELECT index_name
+            FROM information_schema.statistics
+            WHERE table_schema = DATABASE()
+                AND table_name = %s
+                AND index_name = %s
+            """, [table, index])
+    return cursor.fetchone() is not None
@@ -0,0 +1,118 @@
+"""Working day calendars used to draw the ideal curve.
+
+A calendar is made from a weekly rule (every day, or weekdays only) and a
+set of holidays. The first time a year is needed the calendar compiles it
+into an integer bitmask, where bit n is set if day n of the year is a
+working day. Masks for any range of days are then cut from those integers
+with shifts rather than comparing each date.
+
+Calendars are shared by every milestone using the same rule and holidays,
+see get_calendar().
+"""
+
+from datetime import date, datetime, timedelta
+
+
+class WorkingCalendar(object):
+    """Working days for a weekly rule and a set of holiday date strings."""
+
+    def __init__(self, weekdays_only, holidays):
+        self.weekdays_only = weekdays_only
+        self.holidays = frozenset(holidays)
+        self._years = {}
+
+    def year_mask(self, year):
+        """Returns the working day bitmask for a year, compiling it the
+        first time the year is used."""
+
+        try:
+            return self._years[year]
+        except KeyError:
+            pass
+
+        first = date(year, 1, 1)
+        bits = 0
+        for i in xrange((date(year + 1, 1, 1) - first).days):
+            day = first + timedelta(days=i)
+            if self.weekdays_only and day.weekday() >= 5:
+                continue
+            if day.strftime('%Y-%m-%d') in self.holidays:
+                continue
+            bits |= 1 << i
+
+        self._years[year] = bits
+        return bits
+
+    def _spans(self, start, length):
+        """Yields (bits, count) tuples covering length days from start,
+        one per calendar year, where bit 0 of bits is the first day."""
+
+        day = start
+        while length > 0:
+            first = date(day.year, 1, 1)
+            offset = (day - first).days
+            count = min(length, (date(day.year + 1, 1, 1) - day).days)
+            bits = (self.year_mask(day.year) >> offset) & ((1 << count) - 1)
+            yield bits, count
+            day += timedelta(days=count)
+            length -= count
+
+    def mask(self, start, length):
+        """Returns a list of booleans, True for each working day in the
+        length days from start."""
+
+        working = []
+        for bits, count in self._spans(start, length):
+            working.extend(c == '1'
+                           for c in reversed(format(bits, '0%db' % count)))
+        return working
+
+
+_calendars = {}
+
+
+def get_calendar(weekdays_only, holidays):
+    """Returns the shared calendar for a weekly rule and holidays."""
+
+    key = (bool(weekdays_only), frozenset(holidays))
+    try:
+        return _calendars[key]
+    except KeyError:
+        calendar = _calendars[key] = WorkingCalendar(*key)
+        return calendar
+
+
+def parse_dates(values):
+    """Splits a list or string of dates separated by commas or whitespace
+    into two sorted lists, the first with all valid yyyy-mm-dd dates and
+    the second with anything which could not be read as a date."""
+
+    if isinstance(values, basestring):
+        values = [values]
+
+    valid, invalid = set(), set()
+    for value in values:
+        for item in value.replace(',', ' ').split():
+            try:
+                valid.add(datetime.strptime(item, '%Y-%m-%d')
+                                  .strftime('%Y-%m-%d'))
+            except ValueError:
+                invalid.add(item)
+
+    return sorted(valid), sorted(invalid)
+
+
+def team_calendars(section):
+    """Returns a list of (name, holidays, milestones) tuples for each team
+    calendar in the [burndown-calendars] config section. A calendar is
+    defined by a `<name>` option listing the holidays, and a
+    `<name>.milestones` option listing the milestones which use it."""
+
+    calendars = []
+    for name, value in section.options():
+        if name.endswith('.milestones'):
+            continue
+        calendars.append((name,
+                          parse_dates(value)[0],
+                          section.getlist(name + '.milestones')))
+    return sorted(calendars)
@@ -42,7 +42,7 @@ setup(
     license='BSD',
     url='http://define.primeportal.com/',
     description='Creates burn down charts based on milestone and ticket data',
-    packages=['burndown'],
+    packages=['burndown', 'burndown.upgrades'],
     package_data={
         'burndown': [
             'htdocs/js/*.js',
@@ -57,6 +57,7 @@ setup(
                       'ComponentDependencyPlugin',
                       'businessintelligenceplugin',
                       ],
+    extras_require={'png': ['cairosvg']},
     tests_require=['nose'],
     test_suite='nose.collector',
 )